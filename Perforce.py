@@ -22,216 +22,1644 @@
 import sublime
 import sublime_plugin
 
+import array
+import bisect
+import collections
 import os
 import stat
 import subprocess
 import tempfile
 import threading
+import fnmatch
+import hashlib
+import heapq
 import json
+import logging
+import logging.handlers
+import marshal
+import re
+import shutil
 import sys
+import time
 try:
-    from Queue import Queue, Empty
+    from Queue import Queue, PriorityQueue, Empty
 except ImportError:
-    from queue import Queue, Empty  # python 3.x
+    from queue import Queue, PriorityQueue, Empty  # python 3.x
 # Plugin Settings are located in 'perforce.sublime-settings' make a copy in the User folder to keep changes
 
-# global variable used when calling p4 - it stores the path of the file in the current view, used to determine with P4CONFIG to use
-# whenever a view is selected, the variable gets updated
-global_folder = ''
+# the connection context of the file in the current view is used by the commands, it determines which P4CONFIG to use
+# whenever a view is selected, the active context gets updated
 class PerforceP4CONFIGHandler(sublime_plugin.EventListener):  
     def on_activated(self, view):
         if view.file_name():
-            global global_folder
-            global_folder, filename = os.path.split(view.file_name())
+            SetActiveContext(GetContextForView(view))
 
 # Executed at startup to store the path of the plugin... necessary to open files relative to the plugin
 perforceplugin_dir = os.getcwdu()
 
+# Settings section
+# the settings are kept in a snapshot that is only refreshed when Perforce.sublime-settings changes,
+# the worker threads and the handlers called on every keystroke read it instead of going through the settings API.
+# The settings API is only used on the main thread, when the plugin is loaded and when the settings change
+def GetSettingsNames():
+    # the names of the settings shipped with the plugin and of the ones written by its commands
+    names = set(['perforce_selectedgraphicaldiffapp_command'])
+    try:
+        f = open(perforceplugin_dir + os.sep + 'Perforce.sublime-settings')
+        try:
+            for line in f:
+                match = re.match(r'\s*"(\w+)"\s*:', line)
+                if(match):
+                    names.add(match.group(1))
+        finally:
+            f.close()
+    except IOError:
+        pass
+    return names
+
+class SettingsSnapshot(object):
+    def __init__(self):
+        self.names = GetSettingsNames()
+        self.values = {}
+        self.listeners = []
+
+    def get(self, in_name, in_default=None):
+        value = self.values.get(in_name)
+        if(value is None):
+            return in_default
+        return value
+
+    def AddListener(self, in_listener):
+        self.listeners.append(in_listener)
+
+    def Load(self):
+        # called on the main thread, the dictionary is replaced at once so a reader never sees half of the values
+        settings = sublime.load_settings('Perforce.sublime-settings')
+        values = {}
+        for name in self.names:
+            values[name] = settings.get(name)
+        self.values = values
+
+    def Refresh(self):
+        # called on the main thread by the settings API
+        self.Load()
+        for listener in self.listeners:
+            listener()
+
+settings_snapshot = SettingsSnapshot()
+settings_snapshot.Load()
+sublime.load_settings('Perforce.sublime-settings').add_on_change('perforce_settings', settings_snapshot.Refresh)
+
+def GetSettings():
+    return settings_snapshot
+
+# the connection parameters given to p4 through its environment, they can be set in Perforce.sublime-settings
+# and overridden by the settings of a project
+p4_connection_settings = ['P4PORT', 'P4CLIENT', 'P4USER', 'P4PASSWD']
+
+def GetProjectOverrides(in_view):
+    overrides = {}
+    for name in p4_connection_settings:
+        value = in_view.settings().get(name)
+        if(value):
+            overrides[name] = value
+    return overrides
+
+# Telemetry section
+# when enabled, every p4 process is recorded in a ring buffer with the action of the user that caused it.
+# The action is the command or the event handler of the plugin being run, it's kept per thread and handed to the tasks
+class Telemetry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.enabled = False
+        self.records = collections.deque()
+        self.size = None # maximum number of records, deque has no maxlen attribute in python 2.6
+        self.actions = {} # action -> number of times it was run while recording
+        self.counter = 0
+
+    def Configure(self):
+        perforce_settings = GetSettings()
+        self.enabled = perforce_settings.get('perforce_telemetry', False)
+        size = perforce_settings.get('perforce_telemetry_size', 1000)
+        if(size != self.size):
+            self.records = collections.deque(self.records, size)
+            self.size = size
+
+    def GetAction(self):
+        return getattr(self.local, 'action', None)
+
+    def SetAction(self, in_action):
+        # returns the previous action of the thread so it can be restored
+        previous = getattr(self.local, 'action', None)
+        self.local.action = in_action
+        return previous
+
+    def StartAction(self, in_name):
+        # each run of an action gets its own number, the processes it spawns are counted per run
+        self.lock.acquire()
+        try:
+            self.counter += 1
+            self.actions[in_name] = self.actions.get(in_name, 0) + 1
+            return self.SetAction((in_name, self.counter))
+        finally:
+            self.lock.release()
+
+    def Record(self, p, in_outsize, in_errsize, in_interruption):
+        slow_command_log.Record(p)
+        if(not self.enabled):
+            return
+        action = p.action or ('background', 0)
+        record = {
+            'time': p.started,
+            'command': p.command,
+            'arguments': len(p.arguments),
+            'wall': time.time() - p.started,
+            'stdout': in_outsize,
+            'stderr': in_errsize,
+            'status': p.returncode,
+            'interrupted': in_interruption,
+            'action': action[0],
+            'run': action[1],
+            'server': p.track
+        }
+        self.lock.acquire()
+        try:
+            self.records.append(record)
+        finally:
+            self.lock.release()
+
+    def GetRecords(self):
+        self.lock.acquire()
+        try:
+            return list(self.records)
+        finally:
+            self.lock.release()
+
+    def Clear(self):
+        self.lock.acquire()
+        try:
+            self.records.clear()
+            self.actions = {}
+        finally:
+            self.lock.release()
+
+    def Aggregate(self, in_field):
+        # returns the statistics of the records grouped by the given field, sorted by total time
+        groups = {}
+        for record in self.GetRecords():
+            groups.setdefault(record[in_field], []).append(record)
+
+        statistics = []
+        for name, records in groups.items():
+            walls = sorted([record['wall'] for record in records])
+            runs = set([record['run'] for record in records])
+            statistics.append({
+                'name': name,
+                'runs': max(self.actions.get(name, 0), len(runs)),
+                'spawns': len(records),
+                'total': sum(walls),
+                'p50': Percentile(walls, 0.5),
+                'p95': Percentile(walls, 0.95),
+                'max': walls[-1],
+                'stdout': sum([record['stdout'] for record in records]),
+                'failures': len([record for record in records if record['status'] or record['interrupted']])
+            })
+        statistics.sort(key=lambda entry: -entry['total'])
+        return statistics
+
+def Percentile(in_sortedvalues, in_fraction):
+    return in_sortedvalues[int(round((len(in_sortedvalues) - 1) * in_fraction))]
+
+telemetry = Telemetry()
+telemetry.Configure()
+settings_snapshot.AddListener(telemetry.Configure)
+
+def TrackAction(in_name, in_method):
+    def tracked(self, *in_args, **in_kwargs):
+        if(not telemetry.enabled):
+            return in_method(self, *in_args, **in_kwargs)
+        # named after the class of the instance, the method can be inherited
+        previous = telemetry.StartAction(self.__class__.__name__ + '.' + in_name)
+        try:
+            return in_method(self, *in_args, **in_kwargs)
+        finally:
+            telemetry.SetAction(previous)
+    return tracked
+
+def TrackActions(in_namespace):
+    # the entry points of the plugin (commands, event handlers and the callbacks of their panels) record the action they run
+    for value in in_namespace.values():
+        if(not isinstance(value, type) or not issubclass(value, (sublime_plugin.TextCommand, sublime_plugin.WindowCommand, sublime_plugin.EventListener, Task))):
+            continue
+        for name, method in value.__dict__.items():
+            # the run method of a task is work done for the action that started it
+            if(name == 'run' and issubclass(value, Task)):
+                continue
+            if((name == 'run' or name.startswith('on_')) and callable(method)):
+                setattr(value, name, TrackAction(name, method))
+
+def FormatStatistics(in_statistics):
+    lines = ['%-56s %6s %7s %9s %9s %9s %9s' % ('', 'runs', 'spawns', 'total s', 'p50 ms', 'p95 ms', 'max ms')]
+    for entry in in_statistics:
+        lines.append('%-56s %6d %7d %9.2f %9.1f %9.1f %9.1f' % (entry['name'][:56], entry['runs'], entry['spawns'], entry['total'],
+            entry['p50'] * 1000, entry['p95'] * 1000, entry['max'] * 1000))
+    return '\n'.join(lines)
+
+class PerforceShowPerformanceStatsCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        if(not telemetry.enabled):
+            sublime.status_message("Perforce: set perforce_telemetry to true to record the p4 commands")
+        records = telemetry.GetRecords()
+        text = "Perforce: " + str(len(records)) + " p4 command(s) recorded\n\nBy action\n"
+        text += FormatStatistics(telemetry.Aggregate('action')) + "\n\nBy p4 command\n"
+        text += FormatStatistics(telemetry.Aggregate('command')) + "\n"
+
+        panel = self.window.get_output_panel('perforce_stats')
+        edit = panel.begin_edit()
+        panel.insert(edit, 0, text)
+        panel.end_edit(edit)
+        self.window.run_command('show_panel', {'panel': 'output.perforce_stats'})
+
+class PerforceExportPerformanceStatsCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        data = {'actions': telemetry.Aggregate('action'), 'commands': telemetry.Aggregate('command'), 'records': telemetry.GetRecords()}
+        view = self.window.new_file()
+        view.set_name('Perforce Performance Stats.json')
+        view.set_scratch(True)
+        view.set_syntax_file('Packages/JavaScript/JSON.tmLanguage')
+        edit = view.begin_edit()
+        view.insert(edit, 0, json.dumps(data, indent=4, sort_keys=True))
+        view.end_edit(edit)
+
+class PerforceClearPerformanceStatsCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        telemetry.Clear()
+
+# Server tracking section
+# with perforce_track, p4 runs with -Ztrack and the server appends the cost of the command to its output: lapse time,
+# rpc messages and the lock wait and held times of each database table. The block is removed before the output is parsed
+def IsTrackLine(in_line):
+    return in_line.startswith('--- ')
+
+def SplitTrackOutput(in_output):
+    # the block starts with the lapse line at the end of the output, diff output has its own lines starting with ---
+    start = in_output.rfind('--- lapse ')
+    if(start == -1 or (start > 0 and in_output[start - 1] != '\n')):
+        return in_output, []
+    lines = in_output[start:].splitlines()
+    if(not all([IsTrackLine(line) for line in lines])):
+        return in_output, []
+    return in_output[:start], lines
+
+def ParseTrackLines(in_lines):
+    track = {'lapse': 0.0, 'rpc_in': 0, 'rpc_out': 0, 'rpc_in_mb': 0, 'rpc_out_mb': 0, 'lock_wait': 0, 'lock_held': 0, 'tables': {}}
+    table = None
+    for line in in_lines:
+        match = re.match(r'--- lapse (\d*\.?\d+)s', line)
+        if(match):
+            track['lapse'] = float(match.group(1))
+            continue
+        match = re.match(r'--- rpc msgs/size in\+out (\d+)\+(\d+)/(\d+)mb\+(\d+)mb', line)
+        if(match):
+            track['rpc_in'], track['rpc_out'], track['rpc_in_mb'], track['rpc_out_mb'] = [int(value) for value in match.groups()]
+            continue
+        match = re.match(r'--- db\.(\w+)', line)
+        if(match):
+            table = match.group(1)
+            continue
+        match = re.match(r'---\s+total lock wait\+held read/write (\d+)ms\+(\d+)ms/(\d+)ms\+(\d+)ms', line)
+        if(match and table):
+            readwait, readheld, writewait, writeheld = [int(value) for value in match.groups()]
+            track['tables'][table] = (readwait + writewait, readheld + writeheld)
+            track['lock_wait'] += readwait + writewait
+            track['lock_held'] += readheld + writeheld
+    return track
+
+def FormatTrack(in_track):
+    if(not in_track):
+        return 'no server data'
+    text = 'server %.3fs, rpc %d+%d msgs %d+%d mb, lock wait %dms held %dms' % (in_track['lapse'], in_track['rpc_in'], in_track['rpc_out'],
+        in_track['rpc_in_mb'], in_track['rpc_out_mb'], in_track['lock_wait'], in_track['lock_held'])
+    tables = sorted(in_track['tables'].items(), key=lambda item: -(item[1][0] + item[1][1]))
+    if(tables and tables[0][1] != (0, 0)):
+        text += ' (' + ', '.join(['db.%s %d+%dms' % (name, times[0], times[1]) for name, times in tables[:3]]) + ')'
+    return text
+
+class SlowCommandLog(object):
+    # the commands slower than perforce_slow_command_threshold are written to a log file rotated at 1 MB
+    def __init__(self):
+        self.logger = logging.getLogger('Perforce.slow_commands')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.handler = None
+        self.threshold = 0
+
+    def Configure(self):
+        # called on the main thread, where the path of the packages can be asked
+        perforce_settings = GetSettings()
+        self.threshold = perforce_settings.get('perforce_slow_command_threshold', 1000) / 1000.0
+        path = perforce_settings.get('perforce_slow_command_log') or os.path.join(sublime.packages_path(), 'User', 'Perforce Slow Commands.log')
+        if(self.handler and self.handler.baseFilename == os.path.abspath(path)):
+            return
+        if(self.handler):
+            self.logger.removeHandler(self.handler)
+            self.handler.close()
+            self.handler = None
+        if(not self.threshold):
+            return
+        try:
+            self.handler = logging.handlers.RotatingFileHandler(path, maxBytes=1024 * 1024, backupCount=3, delay=True)
+        except (IOError, OSError, TypeError):
+            return
+        self.handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        self.logger.addHandler(self.handler)
+
+    def Record(self, p):
+        if(not self.handler or not self.threshold or p.command in p4_local_commands):
+            return
+        wall = time.time() - p.started
+        if(wall < self.threshold):
+            return
+        action = (p.action or ('background', 0))[0]
+        arguments = ' '.join(p.arguments)
+        if(len(arguments) > 200):
+            arguments = arguments[:200] + '...'
+        self.logger.info('%.3fs p4 %s [%s] %s' % (wall, arguments, action, FormatTrack(p.track)))
+
+slow_command_log = SlowCommandLog()
+slow_command_log.Configure()
+settings_snapshot.AddListener(slow_command_log.Configure)
+
 # Utility functions
-def ConstructCommand(in_command):
-    command = ''
-    if(sublime.platform() == "osx"):
-        command = 'source ~/.bash_profile && '
-    # Revert change until threading is fixed
-    # command = getPerforceConfigFromPreferences(command)
-    command += in_command
-    return command
-
-def getPerforceConfigFromPreferences(command):
-    perforce_settings = sublime.load_settings('Perforce.sublime-settings')
-
-    # check to see if the sublime preferences include the given p4 config
-    # if it does, then add it to the command in the form "var=value command"
-    # so that they get inserted into the environment the command runs in
-    def addP4Var(command, var):
-        p4var = perforce_settings.get(var)
-        if p4var:
-            if sublime.platform() == "windows":
-                return command + "SET " + var + "=" + p4var + " && "
-            return command + var + "=" + p4var + " "
-        return command
-    command = addP4Var(command, "P4PORT")
-    command = addP4Var(command, "P4CLIENT")
-    command = addP4Var(command, "P4USER")
-    command = addP4Var(command, "P4PASSWD")
-    return command
-
-def GetUserFromClientspec():
-    command = ConstructCommand('p4 info')
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
 
-    if(err):
-        WarnUser("usererr " + err.strip())
-        return -1 
+# Process section
+# p4 is started directly from a list of arguments, without a shell. The environment and the path of the executable
+# are resolved once (on osx the bash profile is only sourced at that moment) and again when the settings change
+class P4Runner(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.environment = None
+        self.executable = None
+        self.semaphore = None
+        self.startupinfo = None
+        self.running = []
+        self.watchdog = None
+
+    def Resolve(self):
+        self.lock.acquire()
+        try:
+            if(self.executable is not None):
+                return
+            perforce_settings = GetSettings()
+
+            environment = dict(os.environ)
+            if(sublime.platform() == "osx"):
+                try:
+                    p = subprocess.Popen(['/bin/bash', '-c', 'source ~/.bash_profile > /dev/null 2>&1; env'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    result, err = p.communicate()
+                    for line in result.splitlines():
+                        key, separator, value = line.partition('=')
+                        if(separator and re.match(r'^\w+$', key)):
+                            environment[key] = value
+                except OSError:
+                    pass
+            for name in p4_connection_settings:
+                if(perforce_settings.get(name)):
+                    environment[name] = perforce_settings.get(name)
+
+            executable = perforce_settings.get('perforce_p4_executable')
+            if(not executable):
+                executable = 'p4'
+                if(sublime.platform() == "windows"):
+                    executable += '.exe'
+                for folder in environment.get('PATH', '').split(os.pathsep):
+                    candidate = os.path.join(folder.strip('"'), executable)
+                    if(os.path.isfile(candidate)):
+                        executable = candidate
+                        break
+
+            if(sublime.platform() == "windows"):
+                # don't flash a console window for every command
+                self.startupinfo = subprocess.STARTUPINFO()
+                self.startupinfo.dwFlags |= getattr(subprocess, 'STARTF_USESHOWWINDOW', 1)
+                self.startupinfo.wShowWindow = 0 # SW_HIDE
+
+            self.semaphore = threading.BoundedSemaphore(perforce_settings.get('perforce_max_concurrent_commands', 4))
+            self.environment = environment
+            self.executable = executable
+        finally:
+            self.lock.release()
 
-    # locate the line containing "User name: " and extract the following name
-    startindex = result.find("User name: ")
-    if(startindex == -1):
-        WarnUser("Unexpected output from 'p4 info'.")
+    def Invalidate(self):
+        self.lock.acquire()
+        try:
+            self.executable = None
+        finally:
+            self.lock.release()
+
+    def GetEnvironment(self):
+        self.Resolve()
+        return self.environment
+
+    def GetTimeout(self, in_command, in_args):
+        # a form like p4 client waits for the user, its -o output is keyed on its own ("client -o") so it's never
+        # given the timeout of the interactive form
+        timeouts = GetSettings().get('perforce_command_timeouts', {})
+        name = in_command
+        if(in_command in p4_form_commands and '-o' in in_args[in_args.index(in_command) + 1:]):
+            name = in_command + ' -o'
+        if(name in timeouts):
+            return timeouts[name]
+        return timeouts.get('default', 30)
+
+    def CheckReachable(self, in_context, in_command):
+        if(in_command in p4_local_commands):
+            return
+        remaining = in_context.unreachable_until - time.time()
+        if(remaining > 0):
+            raise P4Error("The Perforce server is unreachable, retrying in %d second(s)." % (remaining + 1))
+
+    def MarkUnreachable(self, in_context, in_message):
+        # the first failure is reported, the next commands fail right away until the cooldown is over
+        perforce_settings = GetSettings()
+        self.lock.acquire()
+        try:
+            report = not in_context.unreachable
+            in_context.unreachable = True
+            in_context.unreachable_until = time.time() + perforce_settings.get('perforce_unreachable_cooldown', 30)
+        finally:
+            self.lock.release()
+        if(report):
+            message = "Perforce: server unreachable, " + in_message.strip().replace('\n', ' ')
+            print message
+            sublime.set_timeout(lambda: sublime.status_message(message), 0)
+
+    def MarkReachable(self, in_context):
+        if(in_context.unreachable):
+            in_context.unreachable = False
+            in_context.unreachable_until = 0
+            print "Perforce: server reachable again"
+
+    def Start(self, in_args, in_timeout=None, in_context=None):
+        # returns a running p4 process, Finish has to be called once it's done
+        self.Resolve()
+        context = in_context or GetCurrentContext()
+        command = GetCommandName(in_args)
+        self.CheckReachable(context, command)
+        if(in_timeout is None):
+            in_timeout = self.GetTimeout(command, in_args)
+        tracked = command not in p4_local_commands and GetSettings().get('perforce_track', False)
+        if(tracked):
+            in_args = ['-Ztrack'] + in_args
+
+        # long commands like a submit can hold every slot, the wait is bounded so the main thread never blocks for long
+        semaphore = self.semaphore
+        deadline = time.time() + GetSettings().get('perforce_command_wait', 10)
+        while not semaphore.acquire(False):
+            if(time.time() > deadline):
+                raise P4Error("Too many p4 commands are running, p4 " + command + " wasn't started.")
+            time.sleep(0.02)
+        try:
+            # stdin is always a pipe, p4 asking for a password gets an end of file instead of waiting forever
+            p = subprocess.Popen([self.executable] + in_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                cwd=context.folder or None, env=context.GetEnvironment(self.environment), startupinfo=self.startupinfo)
+        except OSError as e:
+            semaphore.release()
+            raise P4Error("Unable to launch p4: " + str(e))
+        except:
+            semaphore.release()
+            raise
+
+        p.command = command
+        p.arguments = in_args
+        p.tracked = tracked
+        p.track = None
+        p.action = telemetry.GetAction()
+        p.started = time.time()
+        p.context = context
+        p.semaphore = semaphore
+        p.timedout = False
+        p.cancelled = False
+        p.deadline = None
+        if(in_timeout):
+            p.deadline = time.time() + in_timeout
+
+        self.lock.acquire()
+        try:
+            self.running.append(p)
+            if(not self.watchdog):
+                self.watchdog = threading.Thread(target=self.Watch)
+                self.watchdog.setDaemon(True)
+                self.watchdog.start()
+        finally:
+            self.lock.release()
+        return p
+
+    def Finish(self, p, in_err='', in_outsize=0, in_recorderrors=''):
+        # returns the reason why the command was interrupted, or None. With -G the errors of the server come as
+        # records on stdout instead of stderr, in_recorderrors has the text of those that matter to the interruption
+        KillProcess(p)
+        p.wait()
+        self.lock.acquire()
+        try:
+            if(p in self.running):
+                self.running.remove(p)
+        finally:
+            self.lock.release()
+        p.semaphore.release()
+
+        interruption = self.GetInterruption(p, in_err + in_recorderrors, in_outsize)
+        telemetry.Record(p, in_outsize, len(in_err), interruption)
+        return interruption
+
+    def GetInterruption(self, p, in_err, in_outsize=0):
+        if(p.cancelled):
+            return "p4 " + p.command + " was cancelled."
+        local = p.command in p4_local_commands
+        if(p.timedout):
+            message = "p4 " + p.command + " didn't answer in time."
+            # a command stopped while its output was coming is slow, the server answered it
+            if(not local and not in_outsize):
+                self.MarkUnreachable(p.context, message)
+            return message
+        if(not local):
+            if(IsServerUnreachableError(in_err)):
+                self.MarkUnreachable(p.context, in_err)
+            else:
+                self.MarkReachable(p.context)
+        return None
+
+    def Watch(self):
+        # kills the commands running for longer than their timeout, stops once nothing is running
+        while True:
+            time.sleep(0.25)
+            self.lock.acquire()
+            try:
+                if(not self.running):
+                    self.watchdog = None
+                    return
+                now = time.time()
+                for p in self.running:
+                    if(p.deadline and now > p.deadline and not p.timedout):
+                        p.timedout = True
+                        KillProcess(p)
+            finally:
+                self.lock.release()
+
+    def Cancel(self):
+        # kills all the running commands, returns how many there were
+        self.lock.acquire()
+        try:
+            running = list(self.running)
+        finally:
+            self.lock.release()
+        for p in running:
+            p.cancelled = True
+            KillProcess(p)
+        return len(running)
+
+    def Run(self, in_args, in_input=None, in_timeout=None, in_context=None):
+        # returns the output and the errors of the command
+        try:
+            p = self.Start(in_args, in_timeout, in_context)
+        except P4Error as e:
+            return '', str(e)
+        result, err = '', ''
+        outsize = 0
+        try:
+            result, err = p.communicate(in_input)
+            outsize = len(result)
+            if(p.tracked):
+                result, tracklines = SplitTrackOutput(result)
+                p.track = ParseTrackLines(tracklines)
+        finally:
+            interruption = self.Finish(p, err, outsize)
+        if(interruption):
+            err = interruption + ' ' + err
+        return result, err
+
+class P4Error(Exception):
+    pass
+
+# options of p4 itself that are followed by a value, they come before the name of the command
+p4_global_options_with_value = ['-b', '-c', '-C', '-d', '-H', '-L', '-p', '-P', '-Q', '-u', '-x', '-z']
+# commands that don't talk to the server
+p4_local_commands = ['set']
+# commands editing a form, they print it instead with -o
+p4_form_commands = ['branch', 'change', 'client', 'job', 'label', 'stream', 'user']
+
+def GetCommandName(in_args):
+    i = 0
+    while(i < len(in_args)):
+        if(not in_args[i].startswith('-')):
+            return in_args[i]
+        if(in_args[i] in p4_global_options_with_value):
+            i += 1
+        i += 1
+    return ''
+
+def IsServerUnreachableError(in_err):
+    return re.search(r'Connect to server failed|TCP connect to .* failed|SSL connect to .* failed', in_err) is not None
+
+def KillProcess(p):
+    if(p.poll() is None):
+        try:
+            p.kill()
+        except OSError:
+            pass
+
+def ReadErrorsInBackground(p):
+    # stderr is read by a thread of its own while the output is processed, p4 writing more errors than the pipe holds
+    # would otherwise wait for the plugin, itself waiting for the end of the output. Returns a function giving the
+    # errors once the process closed stderr
+    errors = []
+    reader = threading.Thread(target=lambda: errors.append(p.stderr.read()))
+    reader.setDaemon(True)
+    reader.start()
+    def get_errors():
+        reader.join()
+        return ''.join(errors)
+    return get_errors
+
+def WriteInputInBackground(p, in_input):
+    # the input is written by a thread of its own while the output is read, p4 runs the arguments of -x - in batches
+    # and writes the output of each batch before reading the next one, so a large input would fill both pipes.
+    # Returns a function giving the error of the write, empty when the whole input was sent
+    errors = []
+    def write():
+        try:
+            try:
+                if(in_input):
+                    p.stdin.write(in_input)
+            finally:
+                p.stdin.close()
+        except (IOError, OSError) as e: # p4 exited before reading all of it
+            errors.append("Unable to send the input of p4 " + p.command + ": " + str(e) + "\n")
+    writer = threading.Thread(target=write)
+    writer.setDaemon(True)
+    writer.start()
+    def get_write_error():
+        writer.join()
+        return ''.join(errors)
+    return get_write_error
+
+p4_runner = P4Runner()
+settings_snapshot.AddListener(p4_runner.Invalidate)
+
+def RunP4(in_args, in_input=None, in_timeout=None, in_context=None):
+    return p4_runner.Run(in_args, in_input, in_timeout, in_context)
+
+def HoldTrackLines(in_lines, in_held):
+    # with -Ztrack the tracking of the server ends the output, a block of lines starting with --- lapse is held back
+    # until a line shows it was part of the output, like a diff header
+    lines = []
+    for line in in_lines:
+        if(line.startswith('--- lapse ') or (in_held and IsTrackLine(line))):
+            in_held.append(line)
+        else:
+            lines.extend(in_held)
+            del in_held[:]
+            lines.append(line)
+    return lines
+
+def StreamP4(in_args, in_output, in_input=None, in_context=None, in_stopped=None):
+    # runs a p4 command in text mode and calls in_output with the complete lines of its output as they come,
+    # in_stopped tells when the rest of the output isn't wanted anymore. Returns the errors of the command
+    try:
+        p = p4_runner.Start(in_args, None, in_context)
+    except P4Error as e:
+        return str(e)
+
+    err = ''
+    outsize = 0
+    try:
+        get_write_error = WriteInputInBackground(p, in_input)
+        get_errors = ReadErrorsInBackground(p)
+        fd = p.stdout.fileno()
+        pending = ''
+        held = []
+        while not (in_stopped and in_stopped()):
+            data = os.read(fd, 65536)
+            if(not data):
+                break
+            outsize += len(data)
+            lines = (pending + data).split('\n')
+            pending = lines.pop()
+            lines = [line.rstrip('\r') for line in lines]
+            if(p.tracked):
+                lines = HoldTrackLines(lines, held)
+            if(lines):
+                in_output(lines)
+
+        if(not (in_stopped and in_stopped())):
+            lines = [pending.rstrip('\r')] if pending else []
+            if(p.tracked):
+                lines = HoldTrackLines(lines, held)
+                p.track = ParseTrackLines(held)
+            if(lines):
+                in_output(lines)
+            err = get_errors() + get_write_error()
+    finally:
+        interruption = p4_runner.Finish(p, err, outsize)
+
+    if(interruption):
+        return interruption + ' ' + err
+    return err
+
+class PerforceCancelCommandsCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        count = p4_runner.Cancel()
+        sublime.status_message("Perforce: " + str(count) + " command(s) cancelled")
+
+# Task section
+# the work of the commands is done by a few shared worker threads instead of a new thread per command.
+# Interactive tasks go ahead of background refreshes, and a task waiting in the queue is replaced by a newer one of the same kind
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+class TaskExecutor(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = PriorityQueue()
+        self.pending = {} # kind -> task waiting in the queue
+        self.latest = {} # kind -> last task submitted
+        self.counter = 0
+        self.workers = 0
+
+    def Submit(self, in_function, in_priority=PRIORITY_INTERACTIVE, in_kind=None, in_done=None, in_context=None):
+        # in_function runs on a worker, in_done is then called on the main thread with its result,
+        # unless a newer task of the same kind was submitted in the meantime. Both run in the context current at submission
+        task = {'function': in_function, 'done': in_done, 'kind': in_kind, 'cancelled': False, 'context': in_context or GetCurrentContext(),
+            'action': telemetry.GetAction()}
+        perforce_settings = GetSettings()
+        self.lock.acquire()
+        try:
+            if(in_kind is not None):
+                if(in_kind in self.pending):
+                    self.pending[in_kind]['cancelled'] = True
+                self.pending[in_kind] = task
+                self.latest[in_kind] = task
+            # the counter keeps the tasks of a same priority in order
+            self.counter += 1
+            self.queue.put((in_priority, self.counter, task))
+            if(self.workers < perforce_settings.get('perforce_worker_threads', 3)):
+                self.workers += 1
+                worker = threading.Thread(target=self.Work)
+                worker.setDaemon(True)
+                worker.start()
+        finally:
+            self.lock.release()
+
+    def Work(self):
+        while True:
+            priority, counter, task = self.queue.get()
+            self.lock.acquire()
+            try:
+                if(self.pending.get(task['kind']) is task):
+                    del self.pending[task['kind']]
+            finally:
+                self.lock.release()
+            if(task['cancelled']):
+                continue
+
+            previous = SetCurrentContext(task['context'])
+            previousaction = telemetry.SetAction(task['action'])
+            try:
+                result = task['function']()
+            except Exception as e:
+                print "Perforce: task failed, " + str(e)
+                continue
+            finally:
+                SetCurrentContext(previous)
+                telemetry.SetAction(previousaction)
+
+            if(task['done']):
+                def deliver(task=task, result=result):
+                    if(task['kind'] is None or self.latest.get(task['kind']) is task):
+                        previousaction = telemetry.SetAction(task['action'])
+                        try:
+                            RunInContext(task['context'], task['done'], result)
+                        finally:
+                            telemetry.SetAction(previousaction)
+                sublime.set_timeout(deliver, 0)
+
+task_executor = TaskExecutor()
+
+class Task(object):
+    # work started by a command, run is called on a worker thread and done with its result on the main thread
+    priority = PRIORITY_INTERACTIVE
+
+    def GetKind(self):
+        return self.__class__.__name__
+
+    def start(self):
+        # the context of the command is kept for the callbacks of the quick panels it opens
+        self.context = GetCurrentContext()
+        task_executor.Submit(self.run, self.priority, self.GetKind(), self.done, self.context)
+
+    def run(self):
+        return None
+
+    def done(self, in_result):
+        pass
+
+# Marshaled output section
+# commands are run with -G so their output is made of python marshaled dictionaries instead of text meant for humans,
+# the records are read one at a time from the pipe instead of buffering the whole output
+def ReadRecords(in_file, in_stats=None):
+    # marshal.load keeps the interpreter locked while it waits on the pipe, which would freeze the other threads
+    # and the timeout of the command. The output is read with os.read instead and decoded from a buffer.
+    # The number of bytes read is added to the size entry of in_stats
+    fd = in_file.fileno()
+    buffer = ''
+    size = 65536
+    eof = False
+    while True:
+        if(buffer.startswith('--- ')):
+            # the server tracking of -Ztrack can come as text lines between the records
+            end = buffer.find('\n')
+            if(end == -1 and not eof):
+                data = os.read(fd, size)
+                if(not data):
+                    eof = True
+                if(in_stats is not None):
+                    in_stats['size'] += len(data)
+                buffer += data
+                continue
+            if(end == -1):
+                end = len(buffer)
+            yield {'code': 'info', 'data': buffer[:end].rstrip('\r')}
+            buffer = buffer[end + 1:]
+            continue
+        try:
+            record = marshal.loads(buffer)
+        except (EOFError, ValueError, TypeError):
+            if(eof):
+                return
+            data = os.read(fd, max(size, len(buffer)))
+            if(not data):
+                eof = True
+            if(in_stats is not None):
+                in_stats['size'] += len(data)
+            buffer += data
+            continue
+        # p4 writes the first version of the format, dumping the record again gives the length it had
+        buffer = buffer[len(marshal.dumps(record, 0)):]
+        yield record
+
+def P4Records(in_args, in_input=None, in_timeout=None, in_context=None):
+    try:
+        p = p4_runner.Start(['-G'] + in_args, in_timeout, in_context)
+    except P4Error as e:
+        yield {'code': 'error', 'data': str(e)}
+        return
+
+    finished = False
+    stats = {'size': 0}
+    recorderrors = ''
+    try:
+        if(isinstance(in_input, dict)):
+            # p4 only understands the first version of the marshal format
+            in_input = marshal.dumps(in_input, 0)
+        # the arguments read by -x - or the spec read by -i
+        get_write_error = WriteInputInBackground(p, in_input)
+        get_errors = ReadErrorsInBackground(p)
+        tracklines = []
+        for record in ReadRecords(p.stdout, stats):
+            if(p.tracked and record.get('code') in ('info', 'text') and IsTrackLine(record.get('data', ''))):
+                tracklines.append(record['data'])
+                continue
+            if(IsErrorRecord(record) and not recorderrors and IsServerUnreachableError(record.get('data', ''))):
+                recorderrors = record['data']
+            yield record
+        if(p.tracked):
+            p.track = ParseTrackLines(tracklines)
+
+        err = get_errors() + get_write_error()
+        finished = True
+        interruption = p4_runner.Finish(p, err, stats['size'], recorderrors)
+        if(interruption):
+            yield {'code': 'error', 'data': interruption + ' ' + err}
+        elif(err.strip()):
+            yield {'code': 'error', 'data': err}
+    finally:
+        # the caller can stop iterating before the end of the output
+        if(not finished):
+            p4_runner.Finish(p, '', stats['size'], recorderrors)
+
+def P4Run(in_args, in_input=None, in_context=None):
+    # returns all the records of a command, or the error message if the command failed
+    records = []
+    for record in P4Records(in_args, in_input, None, in_context):
+        if(IsErrorRecord(record)):
+            return 0, GetRecordError(record)
+        records.append(record)
+    return 1, records
+
+def P4RecordsOnFiles(in_args, in_filenames):
+    # the file names are given to p4 through -x - so any number of files costs a single process per chunk,
+    # and per workspace when the files belong to several of them
+    perforce_settings = GetSettings()
+    chunksize = perforce_settings.get('perforce_batch_size', 5000)
+    for context, filenames in GroupFilesByContext(in_filenames):
+        for start in range(0, len(filenames), chunksize):
+            chunk = filenames[start:start + chunksize]
+            for record in P4Records(['-x', '-'] + in_args, '\n'.join(chunk) + '\n', None, context):
+                yield record
+
+def IsErrorRecord(in_record):
+    return in_record.get('code') == 'error'
+
+def GetRecordError(in_record):
+    return in_record.get('data', '').strip()
+
+def GetRecordList(in_record, in_field):
+    # lists are flattened by -G, View becomes View0, View1...
+    values = []
+    index = 0
+    while (in_field + str(index)) in in_record:
+        values.append(in_record[in_field + str(index)])
+        index += 1
+    return values
+
+# Spec section
+# a spec is a form of p4 (change, client...) held as a dictionary where the lists like Files or View are python lists.
+# It's read from the record of p4 -G and written back as a record given to p4 -i through its standard input, where
+# -G flattens the lists into Files0, Files1...
+spec_list_fields = ['Files', 'View', 'AltRoots', 'Jobs', 'ChangeView', 'Paths', 'Remapped', 'Ignored']
+spec_list_field_regex = re.compile(r'^(' + '|'.join(spec_list_fields) + r')\d+$')
+
+def SpecFromRecord(in_record):
+    spec = {}
+    for field, value in in_record.items():
+        if(field != 'code' and not spec_list_field_regex.match(field)):
+            spec[field] = value
+    for field in spec_list_fields:
+        values = GetRecordList(in_record, field)
+        if(values):
+            spec[field] = values
+    return spec
+
+def RecordFromSpec(in_spec):
+    record = {}
+    for field, value in in_spec.items():
+        if(isinstance(value, list)):
+            for index, item in enumerate(value):
+                record[field + str(index)] = item
+        else:
+            record[field] = value
+    return record
+
+# Connection context section
+# a context is where and as who p4 runs: the folder it's launched from, the P4CONFIG file found from there and the port,
+# client and user that file sets. There is one context per P4CONFIG file, each one keeps the caches of its workspace.
+# Commands capture the context when they start, activating another view in the meantime doesn't affect them
+class P4Context(object):
+    def __init__(self, in_configfile, in_overrides):
+        self.key = (in_configfile, tuple(sorted(in_overrides.items())))
+        self.configfile = in_configfile
+        self.overrides = in_overrides
+        self.folder = os.path.dirname(in_configfile)
+        self.configkey = False # modification time of the P4CONFIG file when it was read
+        self.checked = 0 # time the modification time was last looked at
+        self.port = ''
+        self.client = ''
+        self.user = ''
+        self.lock = threading.Lock()
+        self.info = None # time and record of p4 info
+        self.clientview = None # time and ClientView
+        self.changelists = PendingChangelists(self)
+        self.depotfiles = DepotFileIndex(self)
+        self.unreachable = False
+        self.unreachable_until = 0
+
+    def Refresh(self):
+        # editing the P4CONFIG file can change the workspace, the caches are dropped when it's modified.
+        # It's looked at every few seconds at most, the context is asked for every file of the batched commands
+        perforce_settings = GetSettings()
+        if(self.configkey is not False and time.time() - self.checked < perforce_settings.get('perforce_p4config_ttl', 10)):
+            return
+        self.checked = time.time()
+
+        configkey = None
+        if(self.configfile):
+            try:
+                configkey = os.path.getmtime(self.configfile)
+            except OSError:
+                pass
+        if(configkey == self.configkey):
+            return
+        self.configkey = configkey
+
+        config = {}
+        if(configkey is not None):
+            try:
+                for line in open(self.configfile, 'r').read().splitlines():
+                    name, separator, value = line.partition('=')
+                    if(separator):
+                        config[name.strip()] = value.strip()
+            except IOError:
+                pass
+        # like p4, the P4CONFIG file wins over the environment
+        self.port = config.get('P4PORT') or self.overrides.get('P4PORT') or perforce_settings.get('P4PORT', '')
+        self.client = config.get('P4CLIENT') or self.overrides.get('P4CLIENT') or perforce_settings.get('P4CLIENT', '')
+        self.user = config.get('P4USER') or self.overrides.get('P4USER') or perforce_settings.get('P4USER', '')
+        self.Invalidate()
+
+    def GetEnvironment(self, in_environment):
+        # the overrides of the project go in the environment of each command, nothing is shared between the threads
+        if(not self.overrides):
+            return in_environment
+        environment = dict(in_environment)
+        environment.update(self.overrides)
+        return environment
+
+    def Invalidate(self):
+        self.lock.acquire()
+        try:
+            self.info = None
+            self.clientview = None
+        finally:
+            self.lock.release()
+        self.changelists.Invalidate()
+
+contexts = {} # P4CONFIG file and project overrides -> context, the files outside of any P4CONFIG tree use the empty name
+contexts_lock = threading.Lock()
+context_local = threading.local()
+active_context = None
+
+def GetContextOfConfigFile(in_configfile, in_overrides):
+    key = (in_configfile, tuple(sorted(in_overrides.items())))
+    contexts_lock.acquire()
+    try:
+        context = contexts.get(key)
+        if(context is None):
+            context = P4Context(in_configfile, in_overrides)
+            contexts[key] = context
+    finally:
+        contexts_lock.release()
+    context.Refresh()
+    return context
+
+def GetContext(in_folder, in_overrides=None):
+    # the overrides of the project default to the ones of the current context
+    if(in_overrides is None):
+        in_overrides = GetCurrentContext().overrides
+    return GetContextOfConfigFile(GetP4ConfigFile(in_folder), in_overrides)
+
+def GetContextForFile(in_filename, in_overrides=None):
+    return GetContext(os.path.dirname(in_filename), in_overrides)
+
+def GetContextForView(in_view):
+    # called on the main thread, the settings of the project are read from the view
+    return GetContextForFile(in_view.file_name(), GetProjectOverrides(in_view))
+
+def GetContexts():
+    contexts_lock.acquire()
+    try:
+        return contexts.values()
+    finally:
+        contexts_lock.release()
+
+def SetActiveContext(in_context):
+    global active_context
+    active_context = in_context
+
+def GetCurrentContext():
+    # the context of the running task, or the one of the active view
+    context = getattr(context_local, 'context', None) or active_context
+    if(context is None):
+        context = GetContextOfConfigFile('', {})
+    return context
+
+def SetCurrentContext(in_context):
+    # returns the previous context of the thread so it can be restored
+    previous = getattr(context_local, 'context', None)
+    context_local.context = in_context
+    return previous
+
+def RunInContext(in_context, in_function, *in_args):
+    previous = SetCurrentContext(in_context)
+    try:
+        return in_function(*in_args)
+    finally:
+        SetCurrentContext(previous)
+
+def GroupFilesByContext(in_filenames):
+    # returns the contexts with their files, in the order the files were given
+    groups = []
+    indexes = {}
+    folders = {} # folder -> context, the files of a folder share it
+    for filename in in_filenames:
+        folder = os.path.dirname(filename)
+        context = folders.get(folder)
+        if(context is None):
+            context = GetContext(folder)
+            folders[folder] = context
+        if(context.key not in indexes):
+            indexes[context.key] = len(groups)
+            groups.append((context, []))
+        groups[indexes[context.key]][1].append(filename)
+    return groups
+
+def InvalidateContexts():
+    # the connection settings may have changed
+    p4config_files_lock.acquire()
+    try:
+        p4config_files.clear()
+    finally:
+        p4config_files_lock.release()
+    for context in GetContexts():
+        context.configkey = False
+        context.Refresh()
+
+settings_snapshot.AddListener(InvalidateContexts)
+
+# Workspace info section
+# the output of 'p4 info' is cached in the context, depot checks happen on every save and would otherwise
+# spawn a process each time
+p4config_name = None
+p4config_files = {} # folder -> time of the lookup and P4CONFIG file found from it
+p4config_files_lock = threading.Lock()
+
+def GetP4ConfigName():
+    # the name of the P4CONFIG file only has to be resolved once
+    global p4config_name
+    if(p4config_name is None):
+        p4config_name = os.environ.get('P4CONFIG', '')
+        if(not p4config_name):
+            result, err = RunP4(['set', '-q', 'P4CONFIG'])
+            if(not err and result.find('=') != -1):
+                p4config_name = result.strip().split('=', 1)[1].split(' (')[0]
+    return p4config_name
+
+def GetP4ConfigFile(in_folder):
+    # p4 looks for the P4CONFIG file in the current folder and all of its parents. What was found is kept for every
+    # folder walked, the files of a tree only stat the folders that weren't looked at recently
+    configname = GetP4ConfigName()
+    if(not configname or not in_folder):
+        return ''
+
+    perforce_settings = GetSettings()
+    ttl = perforce_settings.get('perforce_p4config_ttl', 10)
+    now = time.time()
+    walked = []
+    configfile = ''
+    folder = in_folder
+    while True:
+        entry = p4config_files.get(folder)
+        if(entry and now - entry[0] < ttl):
+            configfile = entry[1]
+            break
+        walked.append(folder)
+        candidate = os.path.join(folder, configname)
+        if(os.path.isfile(candidate)):
+            configfile = candidate
+            break
+        parent = os.path.dirname(folder)
+        if(parent == folder):
+            break
+        folder = parent
+
+    p4config_files_lock.acquire()
+    try:
+        if(len(p4config_files) > 100000):
+            p4config_files.clear()
+        for folder in walked:
+            p4config_files[folder] = (now, configfile)
+    finally:
+        p4config_files_lock.release()
+    return configfile
+
+def GetWorkspaceInfo(in_context=None):
+    perforce_settings = GetSettings()
+    ttl = perforce_settings.get('perforce_workspace_info_ttl', 300)
+
+    context = in_context or GetCurrentContext()
+    context.lock.acquire()
+    try:
+        entry = context.info
+        if(entry and time.time() - entry[0] < ttl):
+            return entry[1]
+    finally:
+        context.lock.release()
+
+    success, records = P4Run(['info'], None, context)
+    if(not success or not records):
+        WarnUser(records or "Unexpected output from 'p4 info'.")
+        return None
+
+    info = records[0]
+    context.lock.acquire()
+    try:
+        context.info = (time.time(), info)
+    finally:
+        context.lock.release()
+    return info
+
+def InvalidateWorkspaceInfo():
+    # called whenever the user or the client could have changed
+    GetCurrentContext().Invalidate()
+
+def GetUserFromClientspec(in_context=None):
+    info = GetWorkspaceInfo(in_context)
+    if(info is None):
         return -1
-    
-    startindex += 11 # advance after 'User name: '
 
-    endindex = result.find("\n", startindex) 
-    if(endindex == -1):
+    if(not info.get('userName')):
         WarnUser("Unexpected output from 'p4 info'.")
         return -1
 
-    return result[startindex:endindex].strip();
+    return info['userName']
 
-def GetClientRoot(in_dir):
+def GetClientRoot(in_context=None):
     # check if the file is in the depot
-    command = ConstructCommand('p4 info')
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
+    info = GetWorkspaceInfo(in_context)
+    if(info is None):
+        return -1
 
-    if(err):
-        WarnUser(err.strip())
-        return -1 
-    
-    # locate the line containing "Client root: " and extract the following path
-    startindex = result.find("Client root: ")
-    if(startindex == -1):
+    if(not info.get('clientRoot')):
         # sometimes the clientspec is not displayed 
         sublime.error_message("Perforce Plugin: p4 info didn't supply a valid clientspec, launching p4 client");
-        command = ConstructCommand('p4 client')
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-        result, err = p.communicate()
-        return -1
-            
-    startindex += 13 # advance after 'Client root: '
-
-    endindex = result.find("\n", startindex) 
-    if(endindex == -1):
-        WarnUser("Unexpected output from 'p4 info'.")
+        context = in_context or GetCurrentContext()
+        result, err = RunP4(['client'], None, None, context)
+        context.Invalidate()
         return -1
 
     # convert all paths to "os.sep" slashes 
-    convertedclientroot = result[startindex:endindex].strip().replace('\\', os.sep).replace('/', os.sep)
+    convertedclientroot = info['clientRoot'].replace('\\', os.sep).replace('/', os.sep)
 
     return convertedclientroot
 
 
-def IsFolderUnderClientRoot(in_folder):
-    # check if the file is in the depot
-    clientroot = GetClientRoot(in_folder)
+# Client View section
+# the View of the clientspec is compiled once per context so depot membership can be decided without calling the server
+
+def SplitViewLine(in_line):
+    # a view line is made of two paths, each of them can be quoted to allow spaces
+    tokens = []
+    current = ''
+    inquotes = False
+    for char in in_line.strip():
+        if(char == '"'):
+            inquotes = not inquotes
+        elif(char.isspace() and not inquotes):
+            if(current):
+                tokens.append(current)
+            current = ''
+        else:
+            current += char
+    if(current):
+        tokens.append(current)
+    return tokens
+
+def CompileViewPath(in_path, in_ignorecase):
+    # returns the regular expression matching the path, the wildcards in the order they appear and
+    # the template used to build this path from the wildcards of the other side of the mapping
+    pattern = ''
+    wildcards = []
+    template = []
+    literal = ''
+    counts = {'...': 0, '*': 0}
+    index = 0
+    while index < len(in_path):
+        wildcard = None
+        if(in_path.startswith('...', index)):
+            wildcard = '...'
+            pattern += '(.*)'
+            index += 3
+        elif(in_path[index] == '*'):
+            wildcard = '*'
+            pattern += '([^/]*)'
+            index += 1
+        elif(in_path.startswith('%%', index) and index + 2 < len(in_path) and in_path[index + 2].isdigit()):
+            wildcard = '%%' + in_path[index + 2]
+            pattern += '([^/]*)'
+            index += 3
+        else:
+            pattern += re.escape(in_path[index])
+            literal += in_path[index]
+            index += 1
+            continue
+
+        if(wildcard in counts):
+            counts[wildcard] += 1
+            wildcard += str(counts[wildcard])
+        wildcards.append(wildcard)
+        template.append(literal)
+        template.append(wildcard)
+        literal = ''
+    template.append(literal)
+
+    # the literal part before the first wildcard is used to discard most mappings without running the regex
+    prefix = template[0]
+    flags = 0
+    if(in_ignorecase):
+        flags = re.IGNORECASE
+        prefix = prefix.lower()
+    return re.compile(pattern + '$', flags), wildcards, template, prefix
+
+class ClientViewMapping(object):
+    def __init__(self, in_depotpath, in_clientpath, in_ignorecase):
+        self.exclude = False
+        self.overlay = False
+        if(in_depotpath.startswith('-')):
+            self.exclude = True
+            in_depotpath = in_depotpath[1:]
+        elif(in_depotpath.startswith('+')):
+            self.overlay = True
+            in_depotpath = in_depotpath[1:]
+
+        self.depotregex, self.depotwildcards, self.depottemplate, self.depotprefix = CompileViewPath(in_depotpath, in_ignorecase)
+        self.clientregex, self.clientwildcards, self.clienttemplate, self.clientprefix = CompileViewPath(in_clientpath, in_ignorecase)
+
+    def Translate(self, in_match, in_wildcards, in_template):
+        # the template alternates literals and wildcards, always starting and ending with a literal
+        values = dict(zip(in_wildcards, in_match.groups()))
+        result = in_template[0]
+        for index in range(1, len(in_template), 2):
+            result += values.get(in_template[index], '') + in_template[index + 1]
+        return result
+
+class ClientView(object):
+    def __init__(self, in_clientname, in_roots, in_viewlines, in_ignorecase):
+        self.clientname = in_clientname
+        self.ignorecase = in_ignorecase
+        self.roots = []
+        for root in in_roots:
+            if(root and root != 'null'):
+                self.roots.append(root.replace('\\', '/').rstrip('/'))
+
+        self.mappings = []
+        for line in in_viewlines:
+            tokens = SplitViewLine(line)
+            if(len(tokens) == 2):
+                self.mappings.append(ClientViewMapping(tokens[0], tokens[1], in_ignorecase))
+        self.mappings.reverse() # the last line of the view has precedence
+
+        # the mappings are indexed by the folder of their literal prefix, a path only runs the regexes of the mappings
+        # found under its own folders instead of those of the whole view
+        self.depotbuckets = {}
+        self.clientbuckets = {}
+        for index, mapping in enumerate(self.mappings):
+            self.depotbuckets.setdefault(mapping.depotprefix[:mapping.depotprefix.rfind('/') + 1], []).append(index)
+            self.clientbuckets.setdefault(mapping.clientprefix[:mapping.clientprefix.rfind('/') + 1], []).append(index)
+        self.depotcandidates = {} # folder -> indexes of the mappings, the files of a folder are usually asked together
+        self.clientcandidates = {}
+
+    def Normalize(self, in_path):
+        if(self.ignorecase):
+            return in_path.lower()
+        return in_path
+
+    def GetCandidates(self, in_buckets, in_cache, in_comparablepath):
+        # the indexes of the mappings which can match the path, in order of precedence. They only depend on the folder
+        folder = in_comparablepath[:in_comparablepath.rfind('/') + 1]
+        candidates = in_cache.get(folder)
+        if(candidates is None):
+            candidates = []
+            position = folder.find('/')
+            while position != -1:
+                candidates.extend(in_buckets.get(folder[:position + 1], ()))
+                position = folder.find('/', position + 1)
+            candidates.sort()
+            if(len(in_cache) > 10000):
+                in_cache.clear()
+            in_cache[folder] = candidates
+        return candidates
+
+    def LocalToClient(self, in_localpath):
+        localpath = in_localpath.replace('\\', '/')
+        comparablepath = self.Normalize(localpath)
+        for root in self.roots:
+            if(comparablepath.startswith(self.Normalize(root) + '/')):
+                return '//' + self.clientname + localpath[len(root):]
+        return None
+
+    def ClientToLocal(self, in_clientpath):
+        prefix = '//' + self.clientname + '/'
+        if(not self.Normalize(in_clientpath).startswith(self.Normalize(prefix)) or not self.roots):
+            return None
+        return self.roots[0].replace('/', os.sep) + os.sep + in_clientpath[len(prefix):].replace('/', os.sep)
+
+    def ClientToDepot(self, in_clientpath):
+        comparablepath = self.Normalize(in_clientpath)
+        for index in self.GetCandidates(self.clientbuckets, self.clientcandidates, comparablepath):
+            mapping = self.mappings[index]
+            if(not comparablepath.startswith(mapping.clientprefix)):
+                continue
+            match = mapping.clientregex.match(in_clientpath)
+            if(match):
+                if(mapping.exclude):
+                    return None
+                return mapping.Translate(match, mapping.clientwildcards, mapping.depottemplate)
+        return None
+
+    def DepotToClient(self, in_depotpath):
+        comparablepath = self.Normalize(in_depotpath)
+        for index in self.GetCandidates(self.depotbuckets, self.depotcandidates, comparablepath):
+            mapping = self.mappings[index]
+            if(not comparablepath.startswith(mapping.depotprefix)):
+                continue
+            match = mapping.depotregex.match(in_depotpath)
+            if(match):
+                if(mapping.exclude):
+                    return None
+                clientpath = mapping.Translate(match, mapping.depotwildcards, mapping.clienttemplate)
+                # a later line of the view mapping the same client file takes it over, unless it's an overlay
+                comparableclientpath = self.Normalize(clientpath)
+                for laterindex in self.GetCandidates(self.clientbuckets, self.clientcandidates, comparableclientpath):
+                    if(laterindex >= index):
+                        break
+                    latermapping = self.mappings[laterindex]
+                    if(latermapping.overlay or not comparableclientpath.startswith(latermapping.clientprefix)):
+                        continue
+                    if(latermapping.clientregex.match(clientpath)):
+                        return None
+                return clientpath
+        return None
+
+    def LocalToDepot(self, in_localpath):
+        clientpath = self.LocalToClient(in_localpath)
+        if(clientpath is None):
+            return None
+        return self.ClientToDepot(clientpath)
+
+    def DepotToLocal(self, in_depotpath):
+        clientpath = self.DepotToClient(in_depotpath)
+        if(clientpath is None):
+            return None
+        return self.ClientToLocal(clientpath)
+
+def GetClientView(in_context=None):
+    # p4 client -o is only called when the workspace info is refreshed
+    context = in_context or GetCurrentContext()
+    clientroot = GetClientRoot(context)
     if(clientroot == -1):
-        return 0
+        return None
 
-    clientroot = clientroot.lower()
+    perforce_settings = GetSettings()
+    ttl = perforce_settings.get('perforce_workspace_info_ttl', 300)
 
-    # convert all paths to "os.sep" slashes 
-    convertedfolder = in_folder.lower().replace('\\', os.sep).replace('/', os.sep);
-    clientrootindex = convertedfolder.find(clientroot); 
+    context.lock.acquire()
+    try:
+        entry = context.clientview
+        if(entry and time.time() - entry[0] < ttl):
+            return entry[1]
+    finally:
+        context.lock.release()
+
+    success, records = P4Run(['client', '-o'], None, context)
+    if(not success or not records):
+        WarnUser(records or "Unexpected output from 'p4 client -o'.")
+        return None
+
+    info = GetWorkspaceInfo(context)
+    if(info and info.get('caseHandling')):
+        ignorecase = info.get('caseHandling') == 'insensitive'
+    else:
+        ignorecase = sublime.platform() == "windows"
+
+    spec = SpecFromRecord(records[0])
+    roots = [spec.get('Root', '')] + spec.get('AltRoots', [])
+    clientview = ClientView(spec.get('Client', ''), roots, spec.get('View', []), ignorecase)
+
+    context.lock.acquire()
+    try:
+        context.clientview = (time.time(), clientview)
+    finally:
+        context.lock.release()
+    return clientview
 
-    if(clientrootindex == -1):
+def IsFileInClientView(in_folder, in_filename):
+    clientview = GetClientView(GetContext(in_folder))
+    if(clientview is None):
+        return 0
+
+    if(clientview.LocalToDepot(os.path.join(in_folder, in_filename)) is None):
         return 0
     
     return 1
 
 def IsFileInDepot(in_folder, in_filename):
-    isUnderClientRoot = IsFolderUnderClientRoot(in_folder);
+    isInClientView = IsFileInClientView(in_folder, in_filename);
     if(os.path.isfile(os.path.join(in_folder, in_filename))): # file exists on disk, not being added
-        if(isUnderClientRoot):
+        if(isInClientView):
             return 1
         else:
             return 0
     else:
-        if(isUnderClientRoot):
+        if(isInClientView):
             return -1 # will be in the depot, it's being added
         else:
             return 0
 
-def GetPendingChangelists():
-    # Launch p4 changes to retrieve all the pending changelists
-    currentuser = GetUserFromClientspec()
-    if(currentuser == -1):
-        return 0, "Unexpected output from 'p4 info'."
-
-    command = ConstructCommand('p4 changes -s pending -u ' + currentuser)  
+class PendingChangelists(object):
+    # the pending changelists of the user are kept between the quick panels. They are reused as is for a few seconds,
+    # then only if the number of the last change of the server didn't move, which is one cheap p4 changes -m1.
+    # The operations of the plugin on changelists invalidate them
+    def __init__(self, in_context):
+        self.context = in_context
+        self.lock = threading.Lock()
+        self.records = None
+        self.key = None # user and last change of the server when the changelists were loaded
+        self.validated = 0
+
+    def Invalidate(self):
+        self.lock.acquire()
+        try:
+            self.records = None
+        finally:
+            self.lock.release()
 
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
-    if(not err):
-        return 1, result
-    return 0, result
+    def IsFresh(self):
+        perforce_settings = GetSettings()
+        return self.records is not None and time.time() - self.validated < perforce_settings.get('perforce_changelists_ttl', 10)
 
-def AppendToChangelistDescription(changelist, input):
-    # First, create an empty changelist, we will then get the cl number and set the description
-    command = ConstructCommand('p4 change -o ' + changelist)
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
+    def GetLastChange(self):
+        success, records = P4Run(['changes', '-m', '1'], None, self.context)
+        if(not success or not records):
+            return None
+        return records[0].get('change')
 
-    if(err):
-        return 0, err
+    def Get(self):
+        # returns the records of p4 changes, newest first, or the error message
+        currentuser = GetUserFromClientspec(self.context)
+        if(currentuser == -1):
+            return 0, "Unexpected output from 'p4 info'."
 
-    # Find the description field and modify it
-    lines = result.splitlines()
+        self.lock.acquire()
+        try:
+            if(self.IsFresh() and self.key[0] == currentuser):
+                return 1, self.records
+
+            lastchange = self.GetLastChange()
+            if(self.records is not None and lastchange is not None and self.key == (currentuser, lastchange)):
+                self.validated = time.time()
+                return 1, self.records
+
+            success, records = P4Run(['changes', '-s', 'pending', '-u', currentuser], None, self.context)
+            if(not success):
+                self.records = None
+                return success, records
+            self.records = records
+            self.key = (currentuser, lastchange)
+            self.validated = time.time()
+            return 1, records
+        finally:
+            self.lock.release()
 
-    descriptionindex = -1
-    for index, line in enumerate(lines):
-        if(line.strip() == "Description:"):
-            descriptionindex = index
-            break;
-    
-    filesindex = -1
-    for index, line in enumerate(lines):
-        if(line.strip() == "Files:"):
-            filesindex = index
-            break;
-
-    if(filesindex == -1): # The changelist is empty
-        endindex = index
-    else:
-        endindex = filesindex - 1
+    def Warm(self):
+        if(not self.IsFresh()):
+            task_executor.Submit(self.Get, PRIORITY_BACKGROUND, ('PendingChangelists', self.context.key), None, self.context)
 
-    perforce_settings = sublime.load_settings('Perforce.sublime-settings')
-    lines.insert(endindex , "\t" + input)
+def GetPendingChangelists():
+    # each record contains the change number and its description
+    return GetCurrentContext().changelists.Get()
+
+def GetChangelistDescription(in_changelist):
+    # the description returned by p4 changes is truncated and ends with a new line
+    return ' '.join(in_changelist.get('desc', '').split())
+
+def ListPendingChangelists():
+    # returns the number and the description of the pending changelists, oldest first
+    success, records = GetPendingChangelists()
+    if(not success):
+        WarnUser(records)
+        return []
+
+    changelists = []
+    for record in records:
+        changelists.insert(0, (record['change'], GetChangelistDescription(record)))
+    return changelists
+
+class PerforcePendingChangelistsHandler(sublime_plugin.EventListener):
+    def on_activated(self, view):
+        # the changelists are loaded in the background so the quick panels open right away
+        if view.file_name():
+            GetContextForView(view).changelists.Warm()
 
-    temp_changelist_description_file = open(os.path.join(tempfile.gettempdir(), "tempchangelist.txt"), 'w')
+def AppendToChangelistDescription(changelist, input):
+    success, records = P4Run(['change', '-o', changelist])
+    if(not success):
+        return 0, records
 
-    try:
-        temp_changelist_description_file.write(perforce_settings.get('perforce_end_line_separator').join(lines))
-    finally:
-        temp_changelist_description_file.close()
+    spec = SpecFromRecord(records[0])
 
-    command = ConstructCommand('p4 change -i < ' + temp_changelist_description_file.name)
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
+    # Append the line to the description field
+    spec['Description'] = spec.get('Description', '').rstrip('\n') + '\n' + input + '\n'
 
-    # Clean up
-    os.unlink(temp_changelist_description_file.name)
+    success, records = P4Run(['change', '-i'], RecordFromSpec(spec))
+    GetCurrentContext().changelists.Invalidate()
+    if(not success):
+        return 0, records
 
-    if(err):
-        return 0, err
-
-    return 1, result
+    return 1, records[0].get('data', '')
 
 def PerforceCommandOnFile(in_command, in_folder, in_filename):
-    command = ConstructCommand('p4 ' + in_command + ' "' + in_filename + '"')
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
+    # the command runs in the context of the file, whatever view is active
+    result, err = RunP4([in_command, os.path.join(in_folder, in_filename)], None, None, GetContext(in_folder))
 
     if(not err):
         return 1, result.strip()
@@ -239,7 +1667,7 @@ def PerforceCommandOnFile(in_command, in_folder, in_filename):
         return 0, err.strip()   
 
 def WarnUser(message):
-    perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+    perforce_settings = GetSettings()
     if(perforce_settings.get('perforce_warnings_enabled')):
         if(perforce_settings.get('perforce_log_warnings_to_status')):
             sublime.status_message("Perforce [warning]: " + message)
@@ -265,9 +1693,230 @@ def IsFileWritable(in_filename):
         return 1
     return 0
 
+# File State section
+# the opened state of the files shown in the editor is kept in memory so commands don't have to ask the server,
+# it is filled by a single p4 fstat and kept current by the commands of the plugin
+class FileStateIndex(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = {} # local path -> fstat fields, depotFile is None when the file isn't in the depot
+        self.tracking = []
+        self.refreshing = False
+
+    def Key(self, in_filename):
+        return os.path.normcase(os.path.normpath(in_filename))
+
+    def Get(self, in_filename):
+        # returns None when the state of the file is unknown
+        if(not in_filename):
+            return None
+        return self.states.get(self.Key(in_filename))
+
+    def Update(self, in_filename, **in_fields):
+        self.lock.acquire()
+        try:
+            state = self.states.setdefault(self.Key(in_filename), {})
+            state.update(in_fields)
+        finally:
+            self.lock.release()
+        sublime.set_timeout(UpdateStatusBars, 0)
+
+    def ClearChangelist(self, in_changelist):
+        # the files of a submitted changelist are not opened anymore
+        self.lock.acquire()
+        try:
+            for state in self.states.values():
+                if(state.get('change') == in_changelist and state.get('action')):
+                    state['action'] = None
+                    state['change'] = None
+                    state['locked'] = False
+                    if(state.get('headRev')):
+                        state['haveRev'] = state['headRev']
+        finally:
+            self.lock.release()
+        sublime.set_timeout(UpdateStatusBars, 0)
+
+    def IsOpened(self, in_filename):
+        # returns None when the state of the file is unknown
+        state = self.Get(in_filename)
+        if(state is None):
+            return None
+        return bool(state.get('action'))
+
+    def StateFromRecord(self, in_record):
+        state = {}
+        for field in ('depotFile', 'action', 'change', 'haveRev', 'headRev', 'type', 'headType', 'ourLock', 'otherLock'):
+            state[field] = in_record.get(field)
+        state['type'] = state['type'] or state['headType']
+        state['locked'] = 'ourLock' in in_record
+        state['lockedbyother'] = 'otherLock0' in in_record or 'otherLock' in in_record
+        return state
+
+    def Refresh(self, in_filenames):
+        # a single p4 fstat for all the files
+        if(not in_filenames):
+            return
+
+        states = {}
+        for filename in in_filenames:
+            states[self.Key(filename)] = {'depotFile': None}
+        for record in P4RecordsOnFiles(['fstat'], in_filenames):
+            if(not IsErrorRecord(record) and record.get('clientFile')):
+                states[self.Key(record['clientFile'])] = self.StateFromRecord(record)
+
+        self.lock.acquire()
+        try:
+            self.states.update(states)
+        finally:
+            self.lock.release()
+        sublime.set_timeout(UpdateStatusBars, 0)
+
+    def RefreshOpened(self):
+        for context in GetContexts():
+            self.RefreshOpenedInContext(context)
+
+    def RefreshOpenedInContext(self, in_context):
+        # only the opened files of the client are queried so the cost doesn't depend on the size of the workspace
+        info = GetWorkspaceInfo(in_context)
+        if(info is None or not info.get('clientName')):
+            return
+
+        opened = {}
+        for record in P4Records(['fstat', '-Ro', '//' + info['clientName'] + '/...'], None, None, in_context):
+            if(IsErrorRecord(record)):
+                if(record.get('severity', 3) > 2): # no opened files is only a warning
+                    return
+            elif(record.get('clientFile')):
+                opened[self.Key(record['clientFile'])] = self.StateFromRecord(record)
+
+        # the files of the other workspaces are left alone
+        self.lock.acquire()
+        try:
+            candidates = [key for key, state in self.states.items() if state.get('action') and key not in opened]
+        finally:
+            self.lock.release()
+        closed = [key for key in candidates if GetContextForFile(key) is in_context]
+
+        self.lock.acquire()
+        try:
+            for key in closed:
+                state = self.states[key]
+                state['action'] = None
+                state['change'] = None
+                state['locked'] = False
+            self.states.update(opened)
+        finally:
+            self.lock.release()
+        sublime.set_timeout(UpdateStatusBars, 0)
+
+    def Track(self, in_filename):
+        # files opened in the editor after startup are queried together a moment later
+        if(not in_filename or self.Get(in_filename) is not None):
+            return
+        self.lock.acquire()
+        try:
+            self.tracking.append(in_filename)
+            if(len(self.tracking) > 1):
+                return
+        finally:
+            self.lock.release()
+
+        def refresh():
+            self.lock.acquire()
+            try:
+                filenames = self.tracking
+                self.tracking = []
+            finally:
+                self.lock.release()
+            task_executor.Submit(lambda: self.Refresh(filenames), PRIORITY_BACKGROUND)
+        sublime.set_timeout(refresh, 500)
+
+    def PeriodicRefresh(self):
+        perforce_settings = GetSettings()
+        interval = perforce_settings.get('perforce_file_state_refresh_interval', 60)
+        if(not interval):
+            return
+
+        def refresh():
+            try:
+                self.RefreshOpened()
+            finally:
+                self.refreshing = False
+
+        if(not self.refreshing):
+            self.refreshing = True
+            task_executor.Submit(refresh, PRIORITY_BACKGROUND)
+        sublime.set_timeout(self.PeriodicRefresh, int(interval * 1000))
+
+file_state_index = FileStateIndex()
+
+def GetFileStateDescription(in_filename):
+    state = file_state_index.Get(in_filename)
+    if(not state or not (state.get('depotFile') or state.get('action'))):
+        return None
+
+    description = 'Perforce: '
+    if(state.get('action')):
+        description += state['action'] + ' in ' + (state.get('change') or 'default') + ' '
+    if(state.get('haveRev') or state.get('headRev')):
+        description += '#' + (state.get('haveRev') or '0') + '/#' + (state.get('headRev') or '0')
+    if(state.get('locked')):
+        description += ' locked'
+    elif(state.get('lockedbyother')):
+        description += ' locked by other'
+    return description.strip()
+
+def UpdateStatusBars():
+    for window in sublime.windows():
+        for view in window.views():
+            description = GetFileStateDescription(view.file_name())
+            if(description):
+                view.set_status('perforce', description)
+            else:
+                view.erase_status('perforce')
+
+def StartFileStateIndex():
+    filenames = []
+    for window in sublime.windows():
+        for view in window.views():
+            if(view.file_name() and view.file_name() not in filenames):
+                filenames.append(view.file_name())
+
+    task_executor.Submit(lambda: file_state_index.Refresh(filenames), PRIORITY_BACKGROUND, None, lambda result: file_state_index.PeriodicRefresh())
+
+sublime.set_timeout(StartFileStateIndex, 1000)
+
+class PerforceFileStateHandler(sublime_plugin.EventListener):
+    def on_load(self, view):
+        file_state_index.Track(view.file_name())
+
+    def on_activated(self, view):
+        description = GetFileStateDescription(view.file_name())
+        if(description):
+            view.set_status('perforce', description)
+
+# base types of the files p4 translates as text, the others are binary
+text_file_types = ['text', 'ktext', 'xtext', 'kxtext', 'unicode', 'utf8']
+
+def IsTextFileType(in_type):
+    # the type can be a full type like text+k, or empty when it isn't known
+    return not in_type or in_type.partition('+')[0] in text_file_types
+
+def NeedsCheckout(in_filename):
+    # when the state of the file isn't known from fstat, a read-only file is considered as not checked out
+    state = file_state_index.Get(in_filename)
+    if(state and state.get('action')):
+        return False
+    if(state and 'depotFile' in state):
+        return bool(state['depotFile'])
+    return not IsFileWritable(in_filename)
+
 # Checkout section
 def Checkout(in_filename):
-    if(IsFileWritable(in_filename)):
+    if(file_state_index.IsOpened(in_filename)):
+        return -1, "File is already opened for " + file_state_index.Get(in_filename)['action'] + "."
+
+    if(not NeedsCheckout(in_filename)):
         return -1, "File is already writable."
 
     folder_name, filename = os.path.split(in_filename)
@@ -277,36 +1926,149 @@ def Checkout(in_filename):
         return -1, "File is not under the client root."
     
     # check out the file
-    return PerforceCommandOnFile("edit", folder_name, in_filename);
+    success, message = PerforceCommandOnFile("edit", folder_name, in_filename);
+    if(success):
+        file_state_index.Update(in_filename, action='edit', change='default')
+    return success, message
   
+class CheckoutQueue(object):
+    # checkouts triggered by the editor run on a worker thread so the UI never waits on p4,
+    # requests for a file already queued are merged and files queued together are opened with a single p4 edit
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {} # file name -> event set once the checkout is done
+        self.inflight = {}
+        self.failures = {} # file name -> time of the last failed checkout
+        self.worker = None
+
+    def Request(self, in_filename):
+        self.lock.acquire()
+        try:
+            event = self.pending.get(in_filename) or self.inflight.get(in_filename)
+            if(event is None):
+                event = threading.Event()
+                self.pending[in_filename] = event
+                if(self.worker is None):
+                    self.worker = threading.Thread(target=self.Run)
+                    self.worker.start()
+            return event
+        finally:
+            self.lock.release()
+
+    def HasFailedRecently(self, in_filename):
+        # avoids launching p4 edit on every keystroke for a file that can't be checked out
+        failuretime = self.failures.get(in_filename)
+        return failuretime is not None and time.time() - failuretime < 30
+
+    def Run(self):
+        perforce_settings = GetSettings()
+        batchdelay = perforce_settings.get('perforce_auto_checkout_batch_delay', 100) / 1000.0
+
+        while True:
+            # give a chance to other requests to join the batch
+            time.sleep(batchdelay)
+
+            self.lock.acquire()
+            try:
+                batch = self.pending
+                self.pending = {}
+                if(not batch):
+                    self.worker = None
+                    return
+                self.inflight.update(batch)
+            finally:
+                self.lock.release()
+
+            try:
+                messages = self.CheckoutFiles(batch.keys())
+            except Exception as e:
+                messages = [(0, "Checkout failed: " + str(e))]
+            finally:
+                self.lock.acquire()
+                try:
+                    for filename in batch.keys():
+                        del self.inflight[filename]
+                finally:
+                    self.lock.release()
+                for event in batch.values():
+                    event.set()
+
+            def report():
+                for success, message in messages:
+                    LogResults(success, message)
+                    if(success == 1):
+                        sublime.status_message("Perforce: " + message)
+            sublime.set_timeout(report, 0)
+
+    def CheckoutFiles(self, in_filenames):
+        messages = []
+        filenames = []
+        for filename in in_filenames:
+            if(not NeedsCheckout(filename)):
+                continue
+            folder_name, name = os.path.split(filename)
+            if(IsFileInDepot(folder_name, name) != 1):
+                self.failures[filename] = time.time()
+                messages.append((-1, "File is not under the client root."))
+                continue
+            filenames.append(filename)
+
+        if(not filenames):
+            return messages
+
+        # check out all the files of a workspace at once
+        for context, contextfilenames in GroupFilesByContext(filenames):
+            for record in P4Records(['edit'] + contextfilenames, None, None, context):
+                if(IsErrorRecord(record)):
+                    messages.append((0, GetRecordError(record)))
+                elif(record.get('depotFile')):
+                    messages.append((1, record['depotFile'] + '#' + record.get('workRev', '') + ' - opened for ' + record.get('action', 'edit')))
+                    if(record.get('clientFile')):
+                        file_state_index.Update(record['clientFile'], action=record.get('action', 'edit'), change='default')
+
+        for filename in filenames:
+            if(not NeedsCheckout(filename)):
+                self.failures.pop(filename, None)
+            else:
+                self.failures[filename] = time.time()
+
+        return messages
+
+checkout_queue = CheckoutQueue()
+
 class PerforceAutoCheckout(sublime_plugin.EventListener):  
     def on_modified(self, view):
         if(not view.file_name()):
             return
 
-        if(IsFileWritable(view.file_name())):
+        if(not NeedsCheckout(view.file_name())):
             return
 
-        perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+        perforce_settings = GetSettings()
 
         # check if this part of the plugin is enabled
         if(not perforce_settings.get('perforce_auto_checkout') or not perforce_settings.get('perforce_auto_checkout_on_modified')):
             return
               
-        if(view.is_dirty()):
-            success, message = Checkout(view.file_name())
-            LogResults(success, message);
+        if(view.is_dirty() and not checkout_queue.HasFailedRecently(view.file_name())):
+            checkout_queue.Request(view.file_name())
 
     def on_pre_save(self, view):
-        perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+        perforce_settings = GetSettings()
 
         # check if this part of the plugin is enabled
         if(not perforce_settings.get('perforce_auto_checkout') or not perforce_settings.get('perforce_auto_checkout_on_save')):
             return
               
-        if(view.is_dirty()):
-            success, message = Checkout(view.file_name())
-            LogResults(success, message);
+        if(view.is_dirty() and NeedsCheckout(view.file_name())):
+            event = checkout_queue.Request(view.file_name())
+            if(IsFileWritable(view.file_name())):
+                return # the save doesn't need the checkout, it goes on in the background
+
+            # the file has to be writable before it's saved, wait for the checkout but never indefinitely
+            event.wait(perforce_settings.get('perforce_auto_checkout_save_timeout', 10))
+            if(not event.isSet()):
+                WarnUser("Checkout of " + view.file_name() + " is still pending.")
 
 class PerforceCheckoutCommand(sublime_plugin.TextCommand):
     def run(self, edit):
@@ -319,7 +2081,10 @@ class PerforceCheckoutCommand(sublime_plugin.TextCommand):
 # Add section
 def Add(in_folder, in_filename):
     # add the file
-    return PerforceCommandOnFile("add", in_folder, in_filename);
+    success, message = PerforceCommandOnFile("add", in_folder, in_filename);
+    if(success):
+        file_state_index.Update(os.path.join(in_folder, in_filename), action='add', change='default')
+    return success, message
 
 class PerforceAutoAdd(sublime_plugin.EventListener):
     preSaveIsFileInDepot = 0
@@ -328,10 +2093,7 @@ class PerforceAutoAdd(sublime_plugin.EventListener):
         if view.file_name() and os.path.isfile(view.file_name()):
             return
 
-        global global_folder
-        global_folder, filename = os.path.split(view.file_name())
-
-        perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+        perforce_settings = GetSettings()
 
         self.preSaveIsFileInDepot = 0
 
@@ -366,16 +2128,13 @@ class PerforceAddCommand(sublime_plugin.TextCommand):
 
 # Rename section
 def Rename(in_filename, in_newname):
-    command = ConstructCommand('p4 integrate -d -t -Di -f "' + in_filename + '" "' + in_newname + '"')
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
+    context = GetContextForFile(in_filename)
+    result, err = RunP4(['integrate', '-d', '-t', '-Di', '-f', in_filename, in_newname], None, None, context)
 
     if(err):
         return 0, err.strip()
     
-    command = ConstructCommand('p4 delete "' + in_filename + '" "' + in_newname + '"')
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
+    result, err = RunP4(['delete', in_filename, in_newname], None, None, context)
 
     if(not err):
         return 1, result.strip()
@@ -406,6 +2165,7 @@ class PerforceRenameCommand(sublime_plugin.WindowCommand):
 def Delete(in_folder, in_filename):
     success, message = PerforceCommandOnFile("delete", in_folder, in_filename)
     if(success):
+        file_state_index.Update(os.path.join(in_folder, in_filename), action='delete', change='default')
         # test if the file is deleted
         if(os.path.isfile(os.path.join(in_folder, in_filename))):
             success = 0
@@ -431,8 +2191,14 @@ class PerforceDeleteCommand(sublime_plugin.WindowCommand):
 
 # Revert section
 def Revert(in_folder, in_filename):
+    if(file_state_index.IsOpened(os.path.join(in_folder, in_filename)) == False):
+        return 0, "File is not opened."
+
     # revert the file
-    return PerforceCommandOnFile("revert", in_folder, in_filename);
+    success, message = PerforceCommandOnFile("revert", in_folder, in_filename);
+    if(success):
+        file_state_index.Update(os.path.join(in_folder, in_filename), action=None, change=None)
+    return success, message
 
 class PerforceRevertCommand(sublime_plugin.TextCommand):
     def run_(self, args): # revert cannot be called when an Edit object exists, manually handle the run routine
@@ -452,9 +2218,87 @@ class PerforceRevertCommand(sublime_plugin.TextCommand):
             WarnUser("View does not contain a file")
 
 # Diff section
-def Diff(in_folder, in_filename):
-    # diff the file
-    return PerforceCommandOnFile("diff", in_folder, in_filename);
+# p4 diff -du is streamed into a scratch view with the diff syntax. The output is read as it comes and inserted by
+# chunks of complete lines, so the first hunk shows up right away and only a few chunks wait for the main thread at
+# any time: the memory used doesn't depend on the size of the diff
+diff_view_streams = {} # diff view id -> thread streaming into it
+
+def GetDiffView(in_window):
+    # each window has one diff view, it's emptied by every new diff
+    for view in in_window.views():
+        if(view.settings().get('perforce_diff_view')):
+            view.set_read_only(False)
+            edit = view.begin_edit()
+            view.erase(edit, sublime.Region(0, view.size()))
+            view.end_edit(edit)
+            view.set_read_only(True)
+            in_window.focus_view(view)
+            return view
+
+    view = in_window.new_file()
+    view.set_name('Perforce: Diff')
+    view.set_scratch(True)
+    view.set_syntax_file('Packages/Diff/Diff.tmLanguage')
+    view.settings().set('perforce_diff_view', True)
+    view.set_read_only(True)
+    return view
+
+class DiffViewThread(Task):
+    def __init__(self, window, in_filenames):
+        self.window = window
+        self.filenames = in_filenames
+        self.view = GetDiffView(window)
+        self.slots = threading.Semaphore(4)
+        self.stopped = False
+        diff_view_streams[self.view.id()] = self
+
+    def GetKind(self):
+        return ('DiffViewThread', self.view.id())
+
+    def Append(self, in_text):
+        # called by the worker, waits while too many chunks are still to be inserted
+        self.slots.acquire()
+        def append():
+            try:
+                # the view was closed, or another diff replaced this one
+                if(self.view.window() is None or diff_view_streams.get(self.view.id()) is not self):
+                    self.stopped = True
+                    return
+                self.view.set_read_only(False)
+                edit = self.view.begin_edit()
+                self.view.insert(edit, self.view.size(), in_text)
+                self.view.end_edit(edit)
+                self.view.set_read_only(True)
+            finally:
+                self.slots.release()
+        sublime.set_timeout(append, 0)
+
+    def AppendLines(self, in_lines):
+        if(in_lines):
+            self.Append('\n'.join(in_lines).decode('utf-8', 'replace') + '\n')
+
+    def StreamDiff(self, in_context, in_filenames):
+        err = StreamP4(['-x', '-', 'diff', '-du'], self.AppendLines, '\n'.join(in_filenames) + '\n', in_context, lambda: self.stopped)
+        if(err.strip()):
+            self.AppendLines(err.strip().splitlines())
+
+    def run(self):
+        for context, filenames in GroupFilesByContext(self.filenames):
+            if(self.stopped):
+                break
+            self.StreamDiff(context, filenames)
+
+    def done(self, in_result):
+        if(diff_view_streams.get(self.view.id()) is not self):
+            return
+        del diff_view_streams[self.view.id()]
+        if(self.view.window() is not None and not self.view.size()):
+            self.view.set_read_only(False)
+            edit = self.view.begin_edit()
+            self.view.insert(edit, 0, "No differences.\n")
+            self.view.end_edit(edit)
+            self.view.set_read_only(True)
+        sublime.status_message("Perforce: diff of " + str(len(self.filenames)) + " file(s) done")
 
 class PerforceDiffCommand(sublime_plugin.TextCommand):
     def run(self, edit): 
@@ -462,63 +2306,407 @@ class PerforceDiffCommand(sublime_plugin.TextCommand):
             folder_name, filename = os.path.split(self.view.file_name())
 
             if(IsFileInDepot(folder_name, filename)):
-                success, message = Diff(folder_name, filename)
+                DiffViewThread(self.view.window(), [self.view.file_name()]).start()
             else:
-                success = 0
-                message = "File is not under the client root."
-
-            LogResults(success, message)
+                LogResults(0, "File is not under the client root.")
         else:
             WarnUser("View does not contain a file")
+
+def FindDiffHunk(in_view, in_point, in_forward):
+    # returns the region of the next or previous @@ line from the point
+    hunks = in_view.find_all(r'^@@ ')
+    if(in_forward):
+        for hunk in hunks:
+            if(hunk.begin() > in_point):
+                return hunk
+    else:
+        for hunk in reversed(hunks):
+            if(hunk.begin() < in_view.line(in_point).begin()):
+                return hunk
+    return None
+
+def GetDiffSourcePosition(in_view, in_point):
+    # the local file comes from the header of its diff, the line from the start of the hunk and the lines in between
+    # that exist in the local file
+    line = in_view.line(in_point)
+    filename = None
+    hunk = None
+    for region in in_view.find_all(r'^(\+\+\+ |==== |@@ )'):
+        if(region.begin() > line.begin()):
+            break
+        text = in_view.substr(in_view.line(region))
+        if(text.startswith('@@ ')):
+            hunk = region
+        else:
+            match = re.match(r'^==== .+ - (.+) ====', text) or re.match(r'^\+\+\+ ([^\t]+)', text)
+            if(match and not match.group(1).startswith('//')):
+                filename = match.group(1).strip()
+            hunk = None
+    if(not filename or not hunk):
+        return None, None
+
+    hunkline = in_view.line(hunk)
+    match = re.match(r'^@@ -\d+(?:,\d+)? \+(\d+)', in_view.substr(hunkline))
+    if(not match):
+        return None, None
+    number = int(match.group(1))
+    if(line.begin() > hunkline.end()):
+        # the text ends with the new line of the line before the point, the last element of the split is empty
+        for text in in_view.substr(sublime.Region(hunkline.end() + 1, line.begin())).split('\n')[:-1]:
+            if(not text.startswith('-')):
+                number += 1
+    return filename, number
+
+class PerforceDiffNextHunkCommand(sublime_plugin.TextCommand):
+    def run(self, edit, forward=True):
+        selection = self.view.sel()
+        point = selection[0].begin() if len(selection) else 0
+        hunk = FindDiffHunk(self.view, point, forward)
+        if(hunk is None):
+            return
+        selection.clear()
+        selection.add(sublime.Region(hunk.begin(), hunk.begin()))
+        self.view.show(hunk)
+
+    def is_enabled(self):
+        return bool(self.view.settings().get('perforce_diff_view')) or IsReviewView(self.view)
+
+class PerforceDiffGotoSourceCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        selection = self.view.sel()
+        if(not len(selection)):
+            return
+        filename, line = GetDiffSourcePosition(self.view, selection[0].begin())
+        if(filename is None):
+            WarnUser("No hunk at the cursor.")
+            return
+        self.view.window().open_file(filename + ':' + str(line), sublime.ENCODED_POSITION)
+
+    def is_enabled(self):
+        return bool(self.view.settings().get('perforce_diff_view')) or IsReviewView(self.view)
                     
-# Graphical Diff With Depot section
-class GraphicalDiffThread(threading.Thread):
-    def __init__(self, in_folder, in_filename, in_endlineseparator, in_command):
-        self.folder = in_folder
-        self.filename = in_filename
-        self.endlineseparator = in_endlineseparator
+# Multiple Files section
+# commands applied to a selection of the side bar or to all the open files, every file goes to the same p4 process
+def ExpandPaths(in_paths, in_walk):
+    # folders are either walked (p4 add doesn't accept wildcards for new files) or turned into a ... wildcard
+    filenames = []
+    for path in in_paths:
+        if(os.path.isdir(path)):
+            if(in_walk):
+                for root, dirs, files in os.walk(path):
+                    for name in files:
+                        filenames.append(os.path.join(root, name))
+            else:
+                filenames.append(os.path.join(path, '...'))
+        else:
+            filenames.append(path)
+    return filenames
+
+def GetOpenFileNames(in_window):
+    filenames = []
+    for view in in_window.views():
+        if(view.file_name() and view.file_name() not in filenames):
+            filenames.append(view.file_name())
+    return filenames
+
+def PerforceCommandOnFiles(in_command, in_filenames):
+    # returns the local files the command succeeded on and the messages to report for each file
+    succeeded = []
+    messages = []
+    for record in P4RecordsOnFiles([in_command], in_filenames):
+        if(IsErrorRecord(record)):
+            messages.append((0, GetRecordError(record)))
+        elif(record.get('clientFile')):
+            succeeded.append(record['clientFile'])
+            messages.append((1, record.get('depotFile', record['clientFile']) + ' - ' + record.get('action', in_command)))
+    return succeeded, messages
+
+class PerforceCommandOnFilesThread(Task):
+    def __init__(self, window, in_command, in_filenames):
+        self.window = window
         self.command = in_command
-        threading.Thread.__init__(self)
+        self.filenames = in_filenames
+
+    def GetKind(self):
+        # commands that change the files are never dropped
+        return None
 
     def run(self):
-        success, content = PerforceCommandOnFile("print", self.folder, self.filename)
-        if(not success):
-            return 0, content
+        succeeded, messages = PerforceCommandOnFiles(self.command, self.filenames)
+        for filename in succeeded:
+            if(self.command == 'revert'):
+                file_state_index.Update(filename, action=None, change=None)
+            else:
+                file_state_index.Update(filename, action=self.command, change='default')
+        return succeeded, messages
+
+    def done(self, in_result):
+        succeeded, messages = in_result
+        for success, message in messages:
+            LogResults(success, message)
+
+        # only the views of the files the command succeeded on are affected
+        succeededkeys = set([file_state_index.Key(filename) for filename in succeeded])
+        for view in self.window.views():
+            if(not view.file_name() or file_state_index.Key(view.file_name()) not in succeededkeys):
+                continue
+            if(self.command == 'revert'):
+                view.run_command('revert')
+            elif(self.command == 'delete'):
+                self.window.focus_view(view)
+                self.window.run_command('close')
+
+        sublime.status_message("Perforce: " + self.command + " done on " + str(len(succeeded)) + " file(s), " + str(len(messages) - len(succeeded)) + " error(s)")
+
+class PerforceCommandOnFilesBase(sublime_plugin.WindowCommand):
+    command = None
+    confirm = False # the command can't be undone, it's confirmed when it applies to more than one file
+
+    def run(self, paths=None):
+        # paths are given by the side bar, otherwise all the open files are used
+        if(paths is None):
+            filenames = GetOpenFileNames(self.window)
+        elif(not paths):
+            WarnUser("No files selected in the side bar to " + self.command)
+            return
+        else:
+            filenames = ExpandPaths(paths, self.command == 'add')
+
+        if(not filenames):
+            WarnUser("No files to " + self.command)
+            return
+
+        if(self.confirm and (len(filenames) > 1 or filenames[0].endswith('...'))):
+            def on_done(picked):
+                if(picked == 0):
+                    self.Apply(filenames)
+            description = str(len(filenames)) + " file(s)"
+            if(len(filenames) == 1):
+                description = filenames[0]
+            self.window.show_quick_panel([self.command.capitalize() + " " + description, "Cancel"], on_done)
+            return
+
+        self.Apply(filenames)
+
+    def Apply(self, in_filenames):
+        PerforceCommandOnFilesThread(self.window, self.command, in_filenames).start()
+
+class PerforceCheckoutFilesCommand(PerforceCommandOnFilesBase):
+    command = 'edit'
 
-        # Create a temporary file to hold the depot version
-        depotFileName = "depot"+self.filename
-        tmp_file = open(os.path.join(tempfile.gettempdir(), depotFileName), 'w')
+class PerforceAddFilesCommand(PerforceCommandOnFilesBase):
+    command = 'add'
 
-        # Remove the first two lines of content
-        linebyline = content.splitlines();
-        content=self.endlineseparator.join(linebyline[1:]);
+class PerforceRevertFilesCommand(PerforceCommandOnFilesBase):
+    command = 'revert'
+    confirm = True
 
+class PerforceDeleteFilesCommand(PerforceCommandOnFilesBase):
+    command = 'delete'
+    confirm = True
+
+class PerforceDiffFilesCommand(PerforceCommandOnFilesBase):
+    command = 'diff'
+
+    def Apply(self, in_filenames):
+        DiffViewThread(self.window, in_filenames).start()
+
+# Revision Cache section
+# a given revision of a depot file never changes, printed revisions are kept on disk and reused until the
+# cache goes over its size, the least recently used revisions are removed first
+class RevisionCache(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = None # cache key -> [size, last use]
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def GetFolder(self):
+        perforce_settings = GetSettings()
+        folder = perforce_settings.get('perforce_revision_cache_folder') or os.path.join(tempfile.gettempdir(), 'SublimePerforceRevisions')
+        if(not os.path.isdir(folder)):
+            os.makedirs(folder)
+        return folder
+
+    def GetBudget(self):
+        perforce_settings = GetSettings()
+        return perforce_settings.get('perforce_revision_cache_size', 256) * 1024 * 1024
+
+    def Load(self, in_folder):
+        # the revisions cached by a previous session are found on disk, their modification time is their last use
+        if(self.entries is not None):
+            return
+        self.entries = {}
+        for name in os.listdir(in_folder):
+            path = os.path.join(in_folder, name)
+            if(name.endswith('.tmp')):
+                RemoveFile(path)
+                continue
+            size = os.path.getsize(path)
+            self.entries[name] = [size, os.path.getmtime(path)]
+            self.size += size
+
+    def Get(self, in_depotfile, in_revision):
+        # returns the path of the cached revision, it is fetched with p4 print when it's not in the cache yet
+        # the same depot path can be on several servers, the address p4 info gives is part of the key even when the
+        # port comes from the environment or p4 set
+        info = GetWorkspaceInfo()
+        if(info is None):
+            return 0, "Unexpected output from 'p4 info'."
+        folder = self.GetFolder()
+        key = hashlib.sha1(info.get('serverAddress', '') + in_depotfile + '#' + in_revision).hexdigest()
+        path = os.path.join(folder, key)
+
+        self.lock.acquire()
         try:
-            tmp_file.write(content)
+            self.Load(folder)
+            entry = self.entries.get(key)
+            if(entry and os.path.isfile(path)):
+                self.hits += 1
+                entry[1] = time.time()
+                os.utime(path, None)
+                return 1, path
+            self.misses += 1
         finally:
-            tmp_file.close()
+            self.lock.release()
 
-        # Launch P4Diff with both files and the same arguments P4Win passes it
-        diffCommand = self.command
-        diffCommand = diffCommand.replace('%depotfile_path', tmp_file.name)
-        diffCommand = diffCommand.replace('%depotfile_name', depotFileName)
-        diffCommand = diffCommand.replace('%file_path', os.path.join(self.folder, self.filename))
-        diffCommand = diffCommand.replace('%file_name', self.filename)
+        # p4 writes to a temporary name first, a revision is never seen half written
+        handle, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        os.close(handle)
+        os.unlink(tmp_path)
 
-        command = ConstructCommand(diffCommand)
-        
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-        result, err = p.communicate()
+        result, err = RunP4(['print', '-q', '-o', tmp_path, in_depotfile + '#' + in_revision])
+        if(err or not os.path.isfile(tmp_path)):
+            RemoveFile(tmp_path)
+            return 0, (err or result).strip()
+
+        os.chmod(tmp_path, stat.S_IREAD | stat.S_IWRITE)
+        size = os.path.getsize(tmp_path)
+
+        self.lock.acquire()
+        try:
+            if(os.path.isfile(path)): # fetched by another thread in the meantime
+                RemoveFile(tmp_path)
+            else:
+                os.rename(tmp_path, path)
+                self.entries[key] = [size, time.time()]
+                self.size += size
+            self.Evict(folder, key)
+        finally:
+            self.lock.release()
+        return 1, path
+
+    def Evict(self, in_folder, in_keep):
+        budget = self.GetBudget()
+        entries = [(entry[1], key) for key, entry in self.entries.items() if key != in_keep]
+        entries.sort()
+        for lastuse, key in entries:
+            if(self.size <= budget):
+                break
+            self.size -= self.entries.pop(key)[0]
+            RemoveFile(os.path.join(in_folder, key))
+
+    def GetStatistics(self):
+        return "Revision cache: " + str(self.hits) + " hit(s), " + str(self.misses) + " miss(es), " + str(len(self.entries or {})) + " revision(s) using " + str(self.size / 1024) + " KB"
+
+revision_cache = RevisionCache()
 
-        # Clean up
-        os.unlink(tmp_file.name);
+def RemoveFile(in_path):
+    try:
+        if(os.path.isfile(in_path)):
+            os.chmod(in_path, stat.S_IWRITE)
+            os.unlink(in_path)
+    except OSError:
+        pass
+
+def GetHaveRevision(in_filename):
+    # the state index usually knows the have revision, otherwise it's queried once
+    state = file_state_index.Get(in_filename)
+    if(not state or not state.get('depotFile') or not state.get('haveRev')):
+        file_state_index.Refresh([in_filename])
+        state = file_state_index.Get(in_filename)
+    if(not state or not state.get('depotFile') or not state.get('haveRev')):
+        return None, None
+    return state['depotFile'], state['haveRev']
+
+class PerforceShowRevisionCacheStatisticsCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        LogResults(1, revision_cache.GetStatistics())
+        sublime.status_message("Perforce: " + revision_cache.GetStatistics())
+
+# Graphical Diff With Depot section
+def RemoveTemporaryFolder(in_folder):
+    # p4 print leaves read-only files behind, they can't be removed on windows without changing their mode first
+    def make_writable(function, path, excinfo):
+        os.chmod(path, stat.S_IWRITE)
+        function(path)
+    shutil.rmtree(in_folder, onerror=make_writable)
+
+def RemoveTemporaryFolderOnExit(p, in_folder):
+    p.wait()
+    RemoveTemporaryFolder(in_folder)
+
+class GraphicalDiffThread(Task):
+    def __init__(self, in_folder, in_filename, in_command):
+        self.folder = in_folder
+        self.filename = in_filename
+        self.command = in_command
+
+    def GetKind(self):
+        return ('GraphicalDiffThread', os.path.join(self.folder, self.filename))
+
+    def run(self):
+        # Create a temporary folder per diff, two files with the same name can be diffed at the same time
+        tmp_folder = tempfile.mkdtemp(prefix='p4diff')
+        launched = False
+        try:
+            depotFileName = "depot"+self.filename
+            depotFilePath = os.path.join(tmp_folder, depotFileName)
+
+            depotfile, haverevision = GetHaveRevision(os.path.join(self.folder, self.filename))
+            if(not depotfile):
+                sublime.set_timeout(lambda: WarnUser("File is not in the depot."), 0)
+                return
+
+            # the have revision comes from the revision cache, the diff tool gets its own copy of it
+            success, cachedFilePath = revision_cache.Get(depotfile, haverevision)
+            if(not success):
+                sublime.set_timeout(lambda: WarnUser(cachedFilePath), 0)
+                return
+            shutil.copyfile(cachedFilePath, depotFilePath)
+
+            # Launch P4Diff with both files and the same arguments P4Win passes it
+            diffCommand = self.command
+            diffCommand = diffCommand.replace('%depotfile_path', depotFilePath)
+            diffCommand = diffCommand.replace('%depotfile_name', depotFileName)
+            diffCommand = diffCommand.replace('%file_path', os.path.join(self.folder, self.filename))
+            diffCommand = diffCommand.replace('%file_name', self.filename)
+
+            # the diff command comes from the settings and is meant for a shell, it gets the environment resolved for p4
+            devnull = open(os.devnull, 'w')
+            try:
+                p = subprocess.Popen(diffCommand, stdout=devnull, stderr=devnull, cwd=GetCurrentContext().folder or None, env=p4_runner.GetEnvironment(), shell=True)
+            finally:
+                devnull.close()
+
+            # the diff tool stays open as long as the user looks at it, a thread of its own waits for it to clean up
+            # so the worker is free for the other tasks
+            waiter = threading.Thread(target=RemoveTemporaryFolderOnExit, args=(p, tmp_folder))
+            waiter.setDaemon(True)
+            waiter.start()
+            launched = True
+        finally:
+            # Clean up
+            if(not launched):
+                RemoveTemporaryFolder(tmp_folder)
 
 def GraphicalDiffWithDepot(self, in_folder, in_filename):
-    perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+    perforce_settings = GetSettings()
     diffcommand = perforce_settings.get('perforce_selectedgraphicaldiffapp_command')
     if not diffcommand:
         diffcommand = perforce_settings.get('perforce_default_graphical_diff_command')
-    GraphicalDiffThread(in_folder, in_filename, perforce_settings.get('perforce_end_line_separator'), diffcommand).start()
+    GraphicalDiffThread(in_folder, in_filename, diffcommand).start()
 
     return 1, "Launching thread for Graphical Diff"
 
@@ -568,78 +2756,307 @@ class PerforceSelectGraphicalDiffApplicationCommand(sublime_plugin.WindowCommand
         settings.set('perforce_selectedgraphicaldiffapp_command', entry['diffcommand'])
         sublime.save_settings('Perforce.sublime-settings')
 
+# Gutter Markers section
+# lines added, modified and deleted since the have revision are marked in the gutter while typing,
+# the have revision is read once from the revision cache and the diff is computed on line hashes
+def CommonPrefixLength(in_a, in_astart, in_b, in_bstart, in_maxlength):
+    # galloping search, the comparisons of slices run in C instead of comparing one line at a time
+    length = 0
+    step = 1
+    while length + step <= in_maxlength and in_a[in_astart + length:in_astart + length + step] == in_b[in_bstart + length:in_bstart + length + step]:
+        length += step
+        step *= 2
+    upper = min(length + step - 1, in_maxlength)
+    while length < upper:
+        middle = (length + upper + 1) // 2
+        if(in_a[in_astart + length:in_astart + middle] == in_b[in_bstart + length:in_bstart + middle]):
+            length = middle
+        else:
+            upper = middle - 1
+    return length
+
+def CommonSuffixLength(in_a, in_aend, in_b, in_bend, in_maxlength):
+    length = 0
+    step = 1
+    while length + step <= in_maxlength and in_a[in_aend - length - step:in_aend - length] == in_b[in_bend - length - step:in_bend - length]:
+        length += step
+        step *= 2
+    upper = min(length + step - 1, in_maxlength)
+    while length < upper:
+        middle = (length + upper + 1) // 2
+        if(in_a[in_aend - middle:in_aend - length] == in_b[in_bend - middle:in_bend - length]):
+            length = middle
+        else:
+            upper = middle - 1
+    return length
+
+def IndexLines(in_hashes):
+    # line hash -> positions in ascending order, used to find where both versions match again after a difference
+    index = {}
+    for position, linehash in enumerate(in_hashes):
+        index.setdefault(linehash, []).append(position)
+    return index
+
+def ComputeLineChanges(in_base, in_baseindex, in_current):
+    # returns the added and modified lines of in_current and the lines where base lines were deleted
+    added = []
+    modified = []
+    deleted = []
+
+    def record(in_basestart, in_baseend, in_currentstart, in_currentend):
+        basecount = in_baseend - in_basestart
+        currentcount = in_currentend - in_currentstart
+        if(currentcount == 0):
+            if(basecount > 0):
+                deleted.append(in_currentstart)
+        elif(basecount == 0):
+            added.extend(range(in_currentstart, in_currentend))
+        else:
+            modified.extend(range(in_currentstart, in_currentstart + min(basecount, currentcount)))
+            added.extend(range(in_currentstart + basecount, in_currentend))
+
+    baseend = len(in_base)
+    currentend = len(in_current)
+    suffix = CommonSuffixLength(in_base, baseend, in_current, currentend, min(baseend, currentend))
+    baseend -= suffix
+    currentend -= suffix
+
+    baseposition = 0
+    currentposition = 0
+    while True:
+        length = CommonPrefixLength(in_base, baseposition, in_current, currentposition, min(baseend - baseposition, currentend - currentposition))
+        baseposition += length
+        currentposition += length
+        if(baseposition >= baseend or currentposition >= currentend):
+            break
+
+        # look for the closest line present in both versions
+        bestcost = None
+        for offset in xrange(0, currentend - currentposition):
+            if(bestcost is not None and offset >= bestcost):
+                break
+            positions = in_baseindex.get(in_current[currentposition + offset])
+            if(not positions):
+                continue
+            positionindex = bisect.bisect_left(positions, baseposition)
+            if(positionindex < len(positions) and positions[positionindex] < baseend):
+                cost = positions[positionindex] - baseposition + offset
+                if(bestcost is None or cost < bestcost):
+                    bestcost = cost
+                    bestbase = positions[positionindex]
+                    bestcurrent = currentposition + offset
+        if(bestcost is None):
+            break
+
+        record(baseposition, bestbase, currentposition, bestcurrent)
+        baseposition = bestbase
+        currentposition = bestcurrent
+
+    record(baseposition, baseend, currentposition, currentend)
+    return added, modified, deleted
+
+def HashLines(in_lines, in_previouslines=None, in_previoushashes=None):
+    # only the lines that changed since the previous update are hashed again
+    if(not in_previouslines):
+        return [hash(line) for line in in_lines]
+
+    maxlength = min(len(in_lines), len(in_previouslines))
+    prefix = CommonPrefixLength(in_previouslines, 0, in_lines, 0, maxlength)
+    suffix = CommonSuffixLength(in_previouslines, len(in_previouslines), in_lines, len(in_lines), maxlength - prefix)
+    middle = [hash(line) for line in in_lines[prefix:len(in_lines) - suffix]]
+    return in_previoushashes[0:prefix] + middle + in_previoushashes[len(in_previoushashes) - suffix:]
+
+class GutterMarkers(object):
+    def __init__(self):
+        self.bases = {} # view id -> (depot file, have revision, line hashes or None when unavailable, index of the hashes)
+        self.previous = {} # view id -> (lines, line hashes) of the previous update
+        self.fetching = set()
+        self.changes = {} # view id -> number of changes, used to only update after the last one
+
+    def IsEnabled(self, view):
+        perforce_settings = GetSettings()
+        return perforce_settings.get('perforce_gutter_markers', True) and view.file_name()
+
+    def Schedule(self, view):
+        if(not self.IsEnabled(view)):
+            return
+        perforce_settings = GetSettings()
+        changecount = self.changes.get(view.id(), 0) + 1
+        self.changes[view.id()] = changecount
+        sublime.set_timeout(lambda: self.Update(view, changecount), perforce_settings.get('perforce_gutter_markers_delay', 250))
+
+    def Update(self, view, in_changecount):
+        if(self.changes.get(view.id()) != in_changecount or view.file_name() is None):
+            return
+
+        # the state index tells when the have revision changed without asking the server
+        state = file_state_index.Get(view.file_name())
+        base = self.bases.get(view.id())
+        if(base is None or (state and state.get('haveRev') and state.get('haveRev') != base[1])):
+            self.FetchBase(view)
+            return
+        if(base[2] is None):
+            return
+
+        viewid = view.id()
+        text = view.substr(sublime.Region(0, view.size()))
+        def compute():
+            lines = text.splitlines()
+            previouslines, previoushashes = self.previous.get(viewid, (None, None))
+            hashes = HashLines(lines, previouslines, previoushashes)
+            self.previous[viewid] = (lines, hashes)
+            return ComputeLineChanges(base[2], base[3], hashes)
+        def draw(changes):
+            self.Draw(view, in_changecount, *changes)
+        task_executor.Submit(compute, PRIORITY_INTERACTIVE, ('gutter markers', viewid), draw)
+
+    def FetchBase(self, view):
+        viewid = view.id()
+        if(viewid in self.fetching):
+            return
+        self.fetching.add(viewid)
+        filename = view.file_name()
+
+        def fetch():
+            try:
+                depotfile, haverevision = GetHaveRevision(filename)
+                lines = None
+                index = None
+                # binary and large files aren't compared line by line, their revision isn't printed in the cache
+                state = file_state_index.Get(filename) or {}
+                perforce_settings = GetSettings()
+                maxsize = perforce_settings.get('perforce_gutter_markers_max_size', 2048) * 1024
+                if(not IsTextFileType(state.get('type')) or (os.path.isfile(filename) and os.path.getsize(filename) > maxsize)):
+                    depotfile = None
+                if(depotfile):
+                    success, path = revision_cache.Get(depotfile, haverevision)
+                    if(success):
+                        content = open(path, 'rb').read()
+                        try:
+                            content = content.decode('utf-8')
+                        except UnicodeDecodeError:
+                            content = content.decode('latin-1')
+                        lines = HashLines(content.splitlines())
+                        index = IndexLines(lines)
+                self.bases[viewid] = (depotfile, haverevision, lines, index)
+            finally:
+                self.fetching.discard(viewid)
+            return lines is not None
+        def schedule(fetched):
+            if(fetched):
+                self.Schedule(view)
+        task_executor.Submit(fetch, PRIORITY_BACKGROUND, None, schedule)
+
+    def Draw(self, view, in_changecount, in_added, in_modified, in_deleted):
+        if(self.changes.get(view.id()) != in_changecount):
+            return
+
+        lastline = view.rowcol(view.size())[0]
+        def regions(in_lines):
+            result = []
+            for line in in_lines:
+                point = view.text_point(min(line, lastline), 0)
+                result.append(sublime.Region(point, point))
+            return result
+
+        flags = sublime.HIDDEN | sublime.PERSISTENT
+        view.add_regions('perforce_added', regions(in_added), 'markup.inserted', 'dot', flags)
+        view.add_regions('perforce_modified', regions(in_modified), 'markup.changed', 'dot', flags)
+        view.add_regions('perforce_deleted', regions(in_deleted), 'markup.deleted', 'circle', flags)
+
+    def Forget(self, view):
+        self.bases.pop(view.id(), None)
+        self.previous.pop(view.id(), None)
+        self.changes.pop(view.id(), None)
+
+gutter_markers = GutterMarkers()
+
+class PerforceGutterMarkersHandler(sublime_plugin.EventListener):
+    def on_load(self, view):
+        gutter_markers.Schedule(view)
+
+    def on_activated(self, view):
+        gutter_markers.Schedule(view)
+
+    def on_modified(self, view):
+        gutter_markers.Schedule(view)
+
+    def on_post_save(self, view):
+        gutter_markers.Schedule(view)
+
+    def on_close(self, view):
+        gutter_markers.Forget(view)
+
 # List Checked Out Files section
-class ListCheckedOutFilesThread(threading.Thread):
+class ListCheckedOutFilesThread(Task):
     def __init__(self, window):
         self.window = window
-        threading.Thread.__init__(self)
 
     def ConvertFileNameToFileOnDisk(self, in_filename):
-        clientroot = GetClientRoot(os.path.dirname(in_filename))
-        if(clientroot == -1):
+        clientview = GetClientView()
+        if(clientview is None):
             return 0
 
-        filename = clientroot + os.sep + in_filename.replace('\\', os.sep).replace('/', os.sep)
+        # the clientFile field is in client syntax, converting it only requires the client root
+        filename = clientview.ClientToLocal(in_filename)
+        if(filename is None):
+            return 0
 
         return filename
 
-    def MakeFileListFromChangelist(self, in_changelistline):
-        files_list = []
-
-        # Launch p4 opened to retrieve all files from changelist
-        command = ConstructCommand('p4 opened -c ' + in_changelistline[1])
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-        result, err = p.communicate()
-        if(not err):
-            lines = result.splitlines()
-            for line in lines:
-                # remove the change #
-                poundindex = line.rfind('#')
-                cleanedfile = line[0:poundindex]
-
-                # just keep the filename
-                cleanedfile = '/'.join(cleanedfile.split('/')[3:])
-
-                file_entry = [cleanedfile[cleanedfile.rfind('/')+1:]]
-                file_entry.append("Changelist: " + in_changelistline[1])
-                file_entry.append(' '.join(in_changelistline[7:]));
-                localfile = self.ConvertFileNameToFileOnDisk(cleanedfile)
-                if(localfile != 0):
-                    file_entry.append(localfile)
-                    files_list.append(file_entry)
-        return files_list
-
     def MakeCheckedOutFileList(self):
-        files_list = self.MakeFileListFromChangelist(['','default','','','','','','Default Changelist']);
-
-        currentuser = GetUserFromClientspec()
-        if(currentuser == -1):
-            return files_list
-
-        # Launch p4 changes to retrieve all the pending changelists
-        command = ConstructCommand('p4 changes -s pending -u ' + currentuser);   
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-        result, err = p.communicate()
+        info = GetWorkspaceInfo()
+        if(info is None or not info.get('userName') or not info.get('clientName')):
+            return []
+
+        # Launch p4 opened once to retrieve the opened files of every changelist of the client
+        openedfiles = []
+        for record in P4Records(['opened', '-u', info['userName'], '-C', info['clientName']]):
+            if(IsErrorRecord(record)):
+                WarnUser(GetRecordError(record))
+                return []
+            openedfiles.append(record)
+        if(not openedfiles):
+            return []
+
+        # the description of the pending changelists comes from the changelists model
+        changelistorder = {'default': 0}
+        descriptions = {'default': 'Default Changelist'}
+        success, records = GetPendingChangelists()
+        if(success):
+            for record in records:
+                changelistorder[record.get('change')] = len(changelistorder)
+                descriptions[record.get('change')] = GetChangelistDescription(record)
 
-        if(not err):
-            changelists = result.splitlines()
+        # group the files by changelist, in the order p4 changes returned them
+        def SortKey(in_openedfile):
+            return changelistorder.get(in_openedfile.get('change'), len(changelistorder)), in_openedfile.get('clientFile', '')
+        openedfiles.sort(key=SortKey)
 
-            # for each line, extract the change, and run p4 opened on it to list all the files
-            for changelistline in changelists:
-                changelistlinesplit = changelistline.split(' ')
-                files_list.extend(self.MakeFileListFromChangelist(changelistlinesplit))
+        files_list = []
+        for openedfile in openedfiles:
+            clientfile = openedfile.get('clientFile', '')
+            localfile = self.ConvertFileNameToFileOnDisk(clientfile)
+            if(localfile == 0):
+                continue
+
+            change = openedfile.get('change', 'default')
+            file_entry = [clientfile[clientfile.rfind('/')+1:]]
+            file_entry.append("Changelist: " + change)
+            file_entry.append(descriptions.get(change, ''))
+            file_entry.append(localfile)
+            files_list.append(file_entry)
 
         return files_list
 
     def run(self):
         self.files_list = self.MakeCheckedOutFileList()
 
-        def show_quick_panel():
-            if not self.files_list:
-                sublime.error_message(__name__ + ': There are no checked out files to list.')
-                return
-            self.window.show_quick_panel(self.files_list, self.on_done)
-        sublime.set_timeout(show_quick_panel, 10)
+    def done(self, in_result):
+        if not self.files_list:
+            sublime.error_message(__name__ + ': There are no checked out files to list.')
+            return
+        self.window.show_quick_panel(self.files_list, self.on_done)
 
     def on_done(self, picked):
         if picked == -1:
@@ -656,42 +3073,49 @@ class PerforceListCheckedOutFilesCommand(sublime_plugin.WindowCommand):
         ListCheckedOutFilesThread(self.window).start()
 
 # Create Changelist section
-def CreateChangelist(description):
-    # First, create an empty changelist, we will then get the cl number and set the description
-    command = ConstructCommand('p4 change -o')   
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
-
-    if(err):
-        return 0, err
-
-    # Find the description field and modify it
-    result = result.replace("<enter description here>", description)
-
-    # Remove all files from the query, we want them to stay in Default
-    filesindex = result.rfind("Files:")
-    # The Files: section we want to get rid of is only present if there's files in the default changelist
-    if(filesindex > 640):
-        result = result[0:filesindex];
-
-    temp_changelist_description_file = open(os.path.join(tempfile.gettempdir(), "tempchangelist.txt"), 'w')
-
-    try:
-        temp_changelist_description_file.write(result)
-    finally:
-        temp_changelist_description_file.close()
+def CreateChangelist(description, in_filenames=[]):
+    # First, get the template of a new changelist, we will then set the description
+    success, records = P4Run(['change', '-o'])
+    if(not success):
+        return 0, records
+
+    spec = SpecFromRecord(records[0])
+    spec['Description'] = description + '\n'
+
+    # the template lists the files of the default changelist, the ones kept in it are moved by p4 change -i itself.
+    # All the others stay in default
+    clientview = GetClientView()
+    defaultfiles = {}
+    for depotfile in spec.get('Files', []):
+        defaultfiles[clientview.Normalize(depotfile) if clientview else depotfile] = depotfile
+    movedfiles = []
+    otherfiles = []
+    for filename in in_filenames:
+        depotfile = clientview.LocalToDepot(filename) if clientview else None
+        if(depotfile is not None and clientview.Normalize(depotfile) in defaultfiles):
+            movedfiles.append((defaultfiles[clientview.Normalize(depotfile)], filename))
+        else:
+            otherfiles.append(filename)
+    spec['Files'] = [depotfile for depotfile, filename in movedfiles]
 
-    command = ConstructCommand('p4 change -i < ' + temp_changelist_description_file.name)
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
+    success, records = P4Run(['change', '-i'], RecordFromSpec(spec))
+    GetCurrentContext().changelists.Invalidate()
+    if(not success):
+        return 0, records
 
-    # Clean up
-    os.unlink(temp_changelist_description_file.name)
+    message = records[0].get('data', '')
+    changelist = message.split(' ')[1]
+    for depotfile, filename in movedfiles:
+        file_state_index.Update(filename, change=changelist)
 
-    if(err):
-        return 0, err
+    # the files opened in another changelist are reopened together
+    for record in P4RecordsOnFiles(['reopen', '-c', changelist], otherfiles):
+        if(IsErrorRecord(record)):
+            return 0, GetRecordError(record)
+    for filename in otherfiles:
+        file_state_index.Update(filename, change=changelist)
 
-    return 1, result
+    return 1, message
 
 class PerforceCreateChangelistCommand(sublime_plugin.WindowCommand):
     def run(self):
@@ -711,79 +3135,57 @@ class PerforceCreateChangelistCommand(sublime_plugin.WindowCommand):
 
 # Move Current File to Changelist
 def MoveFileToChangelist(in_filename, in_changelist):
-    folder_name, filename = os.path.split(in_filename)
-
-    command = ConstructCommand('p4 reopen -c ' + in_changelist + ' "' + filename + '"')
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-    result, err = p.communicate()
+    context = GetContextForFile(in_filename)
+    result, err = RunP4(['reopen', '-c', in_changelist, in_filename], None, None, context)
+    context.changelists.Invalidate()
 
     if(err):
         return 0, err
-    
+
+    file_state_index.Update(in_filename, change=in_changelist)
     return 1, result
 
-class ListChangelistsAndMoveFileThread(threading.Thread):
+class ListChangelistsAndMoveFileThread(Task):
     def __init__(self, window):
         self.window = window
         self.view = window.active_view()
-        threading.Thread.__init__(self)
 
     def MakeChangelistsList(self):
-        success, rawchangelists = GetPendingChangelists();
-
-        resultchangelists = ['New', 'Default'];
-
-        if(success):
-            changelists = rawchangelists.splitlines()
-
-            # for each line, extract the change
-            for changelistline in changelists:
-                changelistlinesplit = changelistline.split(' ')
-                
-                # Insert at two because we receive the changelist in the opposite order and want to keep new and default on top
-                resultchangelists.insert(2, "Changelist " + changelistlinesplit[1] + " - " + ' '.join(changelistlinesplit[7:])) 
+        # new and default stay on top, the changes picked are kept next to the entries of the quick panel
+        self.changes = ['New', 'default']
+        resultchangelists = ['New', 'Default']
+        for change, description in ListPendingChangelists():
+            self.changes.append(change)
+            resultchangelists.append("Changelist " + change + " - " + description)
 
         return resultchangelists
 
     def run(self):
         self.changelists_list = self.MakeChangelistsList()
-        
-        def show_quick_panel():
-            if not self.changelists_list:
-                sublime.error_message(__name__ + ': There are no changelists to list.')
-                return
-            self.window.show_quick_panel(self.changelists_list, self.on_done)
 
-        sublime.set_timeout(show_quick_panel, 10)
+    def done(self, in_result):
+        if not self.changelists_list:
+            sublime.error_message(__name__ + ': There are no changelists to list.')
+            return
+        self.window.show_quick_panel(self.changelists_list, self.on_done)
 
     def on_done(self, picked):
         if picked == -1:
             return
-        changelistlist = self.changelists_list[picked].split(' ')
+        changelist = self.changes[picked]
 
         def move_file():
-            changelist = 'Default'
-            if(len(changelistlist) > 1): # Numbered changelist
-                changelist = changelistlist[1]
-            else:
-                changelist = changelistlist[0]
-
             if(changelist == 'New'): # Special Case
                 self.window.show_input_panel('Changelist Description', '', self.on_description_done, self.on_description_change, self.on_description_cancel)
             else:
-                success, message = MoveFileToChangelist(self.view.file_name(), changelist.lower())
+                success, message = MoveFileToChangelist(self.view.file_name(), changelist)
                 LogResults(success, message);
 
         sublime.set_timeout(move_file, 10)
 
     def on_description_done(self, input):
-        success, message = CreateChangelist(input)
-        if(success == 1):
-            # Extract the changelist name from the message
-            changelist = message.split(' ')[1]
-            # Move the file
-            success, message = MoveFileToChangelist(self.view.file_name(), changelist)
-
+        # the file is moved by the creation of the changelist
+        success, message = RunInContext(self.context, CreateChangelist, input, [self.view.file_name()])
         LogResults(success, message)
     
     def on_description_change(self, input):
@@ -802,60 +3204,49 @@ class PerforceMoveCurrentFileToChangelistCommand(sublime_plugin.WindowCommand):
             WarnUser("File is not under the client root.")
             return 0
 
+        if(file_state_index.IsOpened(self.window.active_view().file_name()) == False):
+            WarnUser("File is not opened.")
+            return 0
+
         ListChangelistsAndMoveFileThread(self.window).start()
 
 # Add Line to Changelist Description
-class AddLineToChangelistDescriptionThread(threading.Thread):
+class AddLineToChangelistDescriptionThread(Task):
     def __init__(self, window):
         self.window = window
         self.view = window.active_view()
-        threading.Thread.__init__(self)
 
     def MakeChangelistsList(self):
-        success, rawchangelists = GetPendingChangelists();
-
-        resultchangelists = [];
-
-        if(success):
-            changelists = rawchangelists.splitlines()
-
-            # for each line, extract the change, and run p4 opened on it to list all the files
-            for changelistline in changelists:
-                changelistlinesplit = changelistline.split(' ')
-                
-                # Insert at zero because we receive the changelist in the opposite order
-                # Might be more efficient to sort...
-                changelist_entry = ["Changelist " + changelistlinesplit[1]]
-                changelist_entry.append(' '.join(changelistlinesplit[7:]));
-                
-                resultchangelists.insert(0, changelist_entry) 
+        self.changes = []
+        resultchangelists = []
+        for change, description in ListPendingChangelists():
+            self.changes.append(change)
+            resultchangelists.append(["Changelist " + change, description])
 
         return resultchangelists
 
     def run(self):
         self.changelists_list = self.MakeChangelistsList()
-        
-        def show_quick_panel():
-            if not self.changelists_list:
-                sublime.error_message(__name__ + ': There are no changelists to list.')
-                return
-            self.window.show_quick_panel(self.changelists_list, self.on_done)
 
-        sublime.set_timeout(show_quick_panel, 10)
+    def done(self, in_result):
+        if not self.changelists_list:
+            sublime.error_message(__name__ + ': There are no changelists to list.')
+            return
+        self.window.show_quick_panel(self.changelists_list, self.on_done)
 
     def on_done(self, picked):
         if picked == -1:
             return
-        changelistlist = self.changelists_list[picked][0].split(' ')
+        changelist = self.changes[picked]
 
         def get_description_line():
-            self.changelist = changelistlist[1]
+            self.changelist = changelist
             self.window.show_input_panel('Changelist Description', '', self.on_description_done, self.on_description_change, self.on_description_cancel)
 
         sublime.set_timeout(get_description_line, 10)
 
     def on_description_done(self, input):
-        success, message = AppendToChangelistDescription(self.changelist, input)
+        success, message = RunInContext(self.context, AppendToChangelistDescription, self.changelist, input)
         
         LogResults(success, message)
     
@@ -870,50 +3261,143 @@ class PerforceAddLineToChangelistDescriptionCommand(sublime_plugin.WindowCommand
         AddLineToChangelistDescriptionThread(self.window).start()
 
 # Submit section
-class SubmitThread(threading.Thread):
-    def __init__(self, window):
+# submit, shelve and unshelve run in the background, the lines sent by the server are shown in an output panel as
+# they come. Once done, only the views of the files the command worked on are reloaded
+def ShowProgressPanel(in_window, in_title):
+    panel = in_window.get_output_panel('perforce_progress')
+    edit = panel.begin_edit()
+    panel.erase(edit, sublime.Region(0, panel.size()))
+    panel.insert(edit, 0, in_title + '\n')
+    panel.end_edit(edit)
+    in_window.run_command('show_panel', {'panel': 'output.perforce_progress'})
+
+def AppendToProgressPanel(in_window, in_lines):
+    text = ''.join([line + '\n' for line in in_lines]).decode('utf-8', 'replace')
+    def append():
+        panel = in_window.get_output_panel('perforce_progress')
+        edit = panel.begin_edit()
+        panel.insert(edit, panel.size(), text)
+        panel.end_edit(edit)
+        panel.show(panel.size())
+    sublime.set_timeout(append, 0)
+
+submit_failures = [
+    (re.compile(r'must resolve|Merges still pending|use .resolve.', re.I), "Files need resolving: run p4 resolve on them, then submit again."),
+    (re.compile(r'out of date|must sync', re.I), "Files are out of date: sync them and resolve, then submit again."),
+    (re.compile(r'locked by|couldn.t be locked|exclusive file already opened', re.I), "Files are locked by another user: wait for them to be unlocked, or ask the owner."),
+    (re.compile(r'No files to submit|No files to shelve|no file\(s\) to', re.I), "The changelist has no files."),
+    (re.compile(r'Change \d+ unknown|unknown change', re.I), "The changelist doesn't exist anymore."),
+]
+
+def ParseSubmitFailure(in_err):
+    # returns what to do about the errors of p4 submit or p4 shelve, each kind of problem is reported once
+    messages = []
+    for line in in_err.splitlines():
+        for regex, message in submit_failures:
+            if(regex.search(line) and message not in messages):
+                messages.append(message)
+    return messages
+
+def GetDepotFileOfOutputLine(in_line):
+    # the lines of submit, shelve and unshelve name the files as //depot/path#revision
+    match = re.search(r'(//[^#\s][^#]*)#\d+', in_line)
+    if(match):
+        return match.group(1)
+    return None
+
+class ChangelistOperationThread(Task):
+    def __init__(self, window, in_command, in_changelist):
         self.window = window
-        self.view = window.active_view()
-        threading.Thread.__init__(self)
+        self.command = in_command
+        self.changelist = in_changelist
+        if(in_command == 'submit'):
+            self.args = ['submit', '-c', in_changelist]
+        elif(in_command == 'shelve'):
+            self.args = ['shelve', '-c', in_changelist]
+        else:
+            self.args = ['unshelve', '-s', in_changelist, '-f']
+        ShowProgressPanel(window, "Perforce: " + ' '.join(self.args))
 
-    def MakeChangelistsList(self):
-        success, rawchangelists = GetPendingChangelists();
+    def GetKind(self):
+        # changes on the server are never dropped
+        return None
 
-        resultchangelists = [];
+    def run(self):
+        depotfiles = []
+        def output(in_lines):
+            for line in in_lines:
+                depotfile = GetDepotFileOfOutputLine(line)
+                if(depotfile):
+                    depotfiles.append(depotfile)
+            AppendToProgressPanel(self.window, in_lines)
+
+        err = StreamP4(self.args, output)
+        GetCurrentContext().changelists.Invalidate()
+        if(err.strip()):
+            AppendToProgressPanel(self.window, err.strip().splitlines())
+
+        # the files are reloaded by their local name
+        localfiles = []
+        clientview = GetClientView()
+        for depotfile in depotfiles:
+            localfile = clientview.DepotToLocal(depotfile) if clientview else None
+            if(localfile):
+                localfiles.append(localfile)
+        # a submit that failed leaves the files opened and maybe locked, an unshelve opens them
+        if(self.command == 'unshelve' or (self.command == 'submit' and err.strip())):
+            file_state_index.Refresh(localfiles)
+        return err, localfiles
+
+    def done(self, in_result):
+        err, localfiles = in_result
+        if(err.strip()):
+            messages = ParseSubmitFailure(err) or [err.strip().splitlines()[-1]]
+            AppendToProgressPanel(self.window, [''] + messages)
+            WarnUser("p4 " + self.command + " failed: " + messages[0])
+            return
 
-        if(success):
-            changelists = rawchangelists.splitlines()
+        if(self.command == 'submit'):
+            file_state_index.ClearChangelist(self.changelist)
 
-            # for each line, extract the change
-            for changelistline in changelists:
-                changelistlinesplit = changelistline.split(' ')
-                
-                # Insert at two because we receive the changelist in the opposite order and want to keep new and default on top
-                resultchangelists.insert(2, "Changelist " + changelistlinesplit[1] + " - " + ' '.join(changelistlinesplit[7:])) 
+        # a submit changes the mode of the files and their keywords, an unshelve their content
+        if(self.command in ('submit', 'unshelve')):
+            keys = set([file_state_index.Key(filename) for filename in localfiles])
+            for window in sublime.windows():
+                for view in window.views():
+                    if(view.file_name() and file_state_index.Key(view.file_name()) in keys and not view.is_dirty()):
+                        view.run_command('revert')
+        sublime.status_message("Perforce: " + self.command + " of changelist " + self.changelist + " done on " + str(len(localfiles)) + " file(s)")
+
+class SubmitThread(Task):
+    def __init__(self, window):
+        self.window = window
+        self.view = window.active_view()
+
+    def MakeChangelistsList(self):
+        self.changes = []
+        resultchangelists = []
+        for change, description in ListPendingChangelists():
+            self.changes.append(change)
+            resultchangelists.append("Changelist " + change + " - " + description)
 
         return resultchangelists
 
     def run(self):
         self.changelists_list = self.MakeChangelistsList()
-        
-        def show_quick_panel():
-            if not self.changelists_list:
-                sublime.error_message(__name__ + ': There are no changelists to list.')
-                return
-            self.window.show_quick_panel(self.changelists_list, self.on_done)
 
-        sublime.set_timeout(show_quick_panel, 10)
+    def done(self, in_result):
+        if not self.changelists_list:
+            sublime.error_message(__name__ + ': There are no changelists to list.')
+            return
+        self.window.show_quick_panel(self.changelists_list, self.on_done)
 
     def on_done(self, picked):
         if picked == -1:
             return
-        changelist = self.changelists_list[picked]
-        changelistsections = changelist.split(' ')
+        changelist = self.changes[picked]
 
         # Check in the selected changelist
-        command = ConstructCommand('p4 submit -c ' + changelistsections[1]);   
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-        result, err = p.communicate()
+        RunInContext(self.context, ChangelistOperationThread(self.window, 'submit', changelist).start)
     
     def on_description_change(self, input):
         pass
@@ -930,9 +3414,8 @@ class PerforceSubmitCommand(sublime_plugin.WindowCommand):
 class PerforceLogoutCommand(sublime_plugin.WindowCommand):
     def run(self):
         try:
-            command = ConstructCommand("p4 set P4PASSWD=")
-            p = subprocess.Popen(command, stdin=subprocess.PIPE,stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)            
-            p.communicate()
+            RunP4(['set', 'P4PASSWD='], '')
+            InvalidateWorkspaceInfo()
         except ValueError:
             pass
 
@@ -942,13 +3425,10 @@ class PerforceLoginCommand(sublime_plugin.WindowCommand):
 
     def on_done(self, password):
         try:
-            command = ConstructCommand("p4 logout")
-            p = subprocess.Popen(command, stdin=subprocess.PIPE,stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)            
-            p.communicate()
+            RunP4(['logout'], '')
             #unset var 
-            command = ConstructCommand("p4 set P4PASSWD=" + password)
-            p = subprocess.Popen(command, stdin=subprocess.PIPE,stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)            
-            p.communicate()
+            RunP4(['set', 'P4PASSWD=' + password], '')
+            InvalidateWorkspaceInfo()
         except ValueError:
             pass
 
@@ -967,61 +3447,929 @@ class PerforceShelveClCommand(sublime_plugin.WindowCommand):
             WarnUser("Unknown Error, does the included P4 Version support Shelve?")
             return -1
 
-class ShelveClCommand(threading.Thread):
+class ShelveClCommand(Task):
     def __init__(self, window, shelve=True):
         self.shelve = shelve
         self.window = window
-        threading.Thread.__init__(self)
+
+    def GetKind(self):
+        return ('ShelveClCommand', self.shelve)
 
     def run(self):
         self.changelists_list = self.MakeChangelistsList()
-        def show_quick_panel():
-            if not self.changelists_list:
-                sublime.error_message(__name__ + ': There are no changelists to list.')
-                return
-            self.window.show_quick_panel(self.changelists_list, self.on_done)
 
-        sublime.set_timeout(show_quick_panel, 10)
+    def done(self, in_result):
+        if not self.changelists_list:
+            sublime.error_message(__name__ + ': There are no changelists to list.')
+            return
+        self.window.show_quick_panel(self.changelists_list, self.on_done)
 
     def on_done(self, picked):
         if picked == -1:
             return
-        changelistlist = self.changelists_list[picked].split(' ')
-
-
-        changelist = 'Default'
-        if(len(changelistlist) > 1): # Numbered changelist
-            changelist = changelistlist[1]
-        else:
-            changelist = changelistlist[0]
-
-        print changelist
+        changelist = self.changes[picked]
 
-        
         if self.shelve:
-            cmdString = "shelve -c" + changelist
+            command = 'shelve'
         else:
-            cmdString = "unshelve -s" + changelist + " -f"
-        command = ConstructCommand("p4 " + cmdString)
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=global_folder, shell=True)
-        result, err = p.communicate()
-        print result
-        if(err):
-            WarnUser("usererr " + err.strip())
-            return -1 
+            command = 'unshelve'
+        RunInContext(self.context, ChangelistOperationThread(self.window, command, changelist).start)
 
     def MakeChangelistsList(self):
-        success, rawchangelists = GetPendingChangelists();
-
+        self.changes = []
         resultchangelists = []
+        for change, description in ListPendingChangelists():
+            self.changes.append(change)
+            resultchangelists.append("Changelist " + change + " - " + description)
+
+        return resultchangelists
+
+# Review Changelist section
+# all the files of a changelist in one buffer, a header line per file followed by its diff. The files of a pending
+# changelist come from one p4 opened and their diffs from one p4 diff -du over -x, the files of a shelved changelist
+# come from p4 describe -S and the diff of each one is only fetched when its header is expanded
+def SplitUnifiedDiff(in_text):
+    # returns the path, the lines and the number of lines added and removed of each file. The lengths given by the @@
+    # lines tell where a hunk ends, a removed line starting with -- isn't taken for the header of the next file
+    files = []
+    current = None
+    oldleft = newleft = 0
+    for line in in_text.splitlines():
+        if(current is not None and (oldleft > 0 or newleft > 0)):
+            if(line.startswith('-')):
+                oldleft -= 1
+                current['removed'] += 1
+            elif(line.startswith('+')):
+                newleft -= 1
+                current['added'] += 1
+            elif(not line.startswith('\\')): # \ No newline at end of file
+                oldleft -= 1
+                newleft -= 1
+            current['lines'].append(line)
+            continue
+
+        match = re.match(r'^@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@', line)
+        if(match and current is not None):
+            oldleft = int(match.group(1) or 1)
+            newleft = int(match.group(2) or 1)
+            current['hunks'] += 1
+            current['lines'].append(line)
+        elif(line.startswith('==== ') or (line.startswith('--- ') and (current is None or current['hunks'] or current['header'] == '---'))):
+            path = re.split(r'[\t#@]', line[5:] if line.startswith('==== ') else line[4:])[0]
+            current = {'path': path, 'header': line[0:3], 'lines': [], 'added': 0, 'removed': 0, 'hunks': 0}
+            files.append(current)
+            # the header of p4 is replaced by the one of the review
+            if(line.startswith('--- ')):
+                current['lines'].append(line)
+        elif(current is not None):
+            current['lines'].append(line)
+    return files
+
+def FormatReviewHeader(in_depotfile, in_revision, in_action, in_diff=None):
+    header = '==== ' + in_depotfile + '#' + in_revision + ' (' + in_action
+    if(in_diff):
+        header += ', +' + str(in_diff['added']) + ' -' + str(in_diff['removed'])
+    return header + ') ===='
+
+def ParseReviewHeader(in_line):
+    # returns the depot file, its revision and its action
+    match = re.match(r'^==== (.+)#(\w+) \(([^,)]+)', in_line)
+    if(not match):
+        return None
+    return match.group(1), match.group(2), match.group(3)
+
+# what p4 diff says about the files it has no diff for
+review_diff_notice_regex = re.compile(r' - file\(s\) (not opened|up-to-date)|file\(s\) not opened for edit|No file\(s\) to diff|no differing files')
+
+def FormatReviewTotals(in_actions, in_added, in_removed):
+    counts = {}
+    for action in in_actions:
+        counts[action] = counts.get(action, 0) + 1
+    totals = str(len(in_actions)) + " file(s): " + ', '.join([str(counts[action]) + ' ' + action for action in sorted(counts.keys())])
+    if(in_added is not None):
+        totals += "; +" + str(in_added) + " -" + str(in_removed) + " line(s)"
+    return totals
+
+def IsReviewView(in_view):
+    return bool(in_view.settings().get('perforce_review_view'))
+
+def GetReviewFileDiff(in_changelist, in_shelved, in_depotfile, in_revision, in_action):
+    # returns the lines of the diff of one file of the changelist
+    if(not in_shelved):
+        result, err = RunP4(['diff', '-du', in_depotfile])
+    elif(in_action in ('add', 'branch', 'move/add', 'import')):
+        result, err = RunP4(['print', '-q', in_depotfile + '@=' + in_changelist])
+        if(not err):
+            lines = result.splitlines()
+            return ['@@ -0,0 +1,' + str(len(lines)) + ' @@'] + ['+' + line for line in lines]
+    elif(in_action in ('delete', 'move/delete', 'purge')):
+        return ['(' + in_action + ')']
+    else:
+        result, err = RunP4(['diff2', '-du', in_depotfile + '#' + in_revision, in_depotfile + '@=' + in_changelist])
+    if(err):
+        return [line for line in err.splitlines() if line.strip()]
+
+    lines = []
+    for diff in SplitUnifiedDiff(result):
+        lines += diff['lines']
+    return lines or ['(no differences)']
+
+class ReviewChangelistThread(Task):
+    def __init__(self, window, in_changelist, in_shelved):
+        self.window = window
+        self.changelist = in_changelist
+        self.shelved = in_shelved
+
+    def GetKind(self):
+        return ('ReviewChangelistThread', self.changelist, self.shelved)
+
+    def ReviewPending(self):
+        success, records = P4Run(['opened', '-c', self.changelist])
+        if(not success):
+            return 0, records
 
+        description = 'Default Changelist'
+        success, changes = GetPendingChangelists()
         if(success):
-            changelists = rawchangelists.splitlines()
+            for change in changes:
+                if(change.get('change') == self.changelist):
+                    description = GetChangelistDescription(change)
+
+        # one p4 diff for all the files, the files opened for add or delete have no diff
+        files = [(record['depotFile'], record.get('rev', 'none'), record.get('action', '')) for record in records if record.get('depotFile')]
+        result, err = RunP4(['-x', '-', 'diff', '-du'], '\n'.join([depotfile for depotfile, revision, action in files]) + '\n')
+        # the files without a diff are reported on stderr, any other error means the diffs are missing
+        errors = [line.strip() for line in err.splitlines() if line.strip() and not review_diff_notice_regex.search(line)]
+        diffs = {}
+        for diff in SplitUnifiedDiff(result):
+            diffs[diff['path']] = diff
+        clientview = GetClientView()
+
+        sections = []
+        added = removed = 0
+        for depotfile, revision, action in files:
+            # the diff names the local file, which is mapped back to the depot
+            diff = diffs.get(depotfile)
+            if(diff is None and clientview):
+                for path, candidate in diffs.items():
+                    if(clientview.LocalToDepot(path) == depotfile):
+                        diff = candidate
+                        break
+            if(diff):
+                added += diff['added']
+                removed += diff['removed']
+            sections.append([FormatReviewHeader(depotfile, revision, action, diff)] + (diff['lines'] if diff else []))
+
+        title = "Changelist " + self.changelist + " - " + description
+        totals = FormatReviewTotals([action for depotfile, revision, action in files], added, removed)
+        if(errors):
+            totals += "\np4 diff failed, the diffs are incomplete: " + ' '.join(errors)
+            sublime.set_timeout(lambda: WarnUser("p4 diff failed: " + ' '.join(errors)), 0)
+        return 1, (title, totals, sections)
+
+    def ReviewShelved(self):
+        success, records = P4Run(['describe', '-S', '-s', self.changelist])
+        if(not success):
+            return 0, records
+        spec = records[0]
+
+        depotfiles = GetRecordList(spec, 'depotFile')
+        revisions = GetRecordList(spec, 'rev')
+        actions = GetRecordList(spec, 'action')
+        sections = []
+        for index, depotfile in enumerate(depotfiles):
+            sections.append([FormatReviewHeader(depotfile, revisions[index], actions[index])])
+
+        title = "Shelved changelist " + self.changelist + " - " + GetChangelistDescription(spec)
+        totals = FormatReviewTotals(actions, None, None) + " - press enter on a file to show its diff"
+        return 1, (title, totals, sections)
 
-            # for each line, extract the change
-            for changelistline in changelists:
-                changelistlinesplit = changelistline.split(' ')
-                
-                resultchangelists.insert(0, "Changelist " + changelistlinesplit[1] + " - " + ' '.join(changelistlinesplit[7:])) 
+    def run(self):
+        if(self.shelved):
+            return self.ReviewShelved()
+        return self.ReviewPending()
+
+    def done(self, in_result):
+        success, review = in_result
+        if(not success):
+            WarnUser(review)
+            return
+        title, totals, sections = review
+        if(not sections):
+            WarnUser("There are no files in changelist " + self.changelist + ".")
+            return
+
+        text = title + '\n' + totals + '\n\n' + '\n'.join([''.join([line + '\n' for line in section]) for section in sections])
+        view = self.window.new_file()
+        view.set_name('Perforce: Review ' + self.changelist)
+        view.set_scratch(True)
+        view.set_syntax_file('Packages/Diff/Diff.tmLanguage')
+        view.settings().set('perforce_review_view', True)
+        view.settings().set('perforce_review_changelist', self.changelist)
+        view.settings().set('perforce_review_shelved', self.shelved)
+        edit = view.begin_edit()
+        view.insert(edit, 0, text.decode('utf-8', 'replace'))
+        view.end_edit(edit)
+        view.set_read_only(True)
+
+class ReviewFileThread(Task):
+    def __init__(self, view, in_header):
+        # created on the main thread, the settings of the view are read here and not by the worker
+        self.view = view
+        self.header = in_header
+        self.depotfile, self.revision, self.action = ParseReviewHeader(in_header)
+        self.changelist = view.settings().get('perforce_review_changelist')
+        self.shelved = view.settings().get('perforce_review_shelved')
+
+    def GetKind(self):
+        return ('ReviewFileThread', self.view.id(), self.depotfile)
+
+    def run(self):
+        return GetReviewFileDiff(self.changelist, self.shelved, self.depotfile, self.revision, self.action)
+
+    def done(self, in_result):
+        # the header is searched again, the view could have changed in the meantime
+        if(self.view.window() is None):
+            return
+        for region in self.view.find_all(r'^==== '):
+            line = self.view.line(region)
+            if(self.view.substr(line) != self.header):
+                continue
+            if(line.end() < self.view.size() and self.view.substr(self.view.line(line.end() + 1))):
+                return # expanded already
+            self.view.set_read_only(False)
+            edit = self.view.begin_edit()
+            self.view.insert(edit, line.end() + 1, ''.join([text + '\n' for text in in_result]).decode('utf-8', 'replace'))
+            self.view.end_edit(edit)
+            self.view.set_read_only(True)
+            return
+
+class PerforceReviewToggleFileCommand(sublime_plugin.TextCommand):
+    # on the header of a file, shows or hides its diff, anywhere else opens the local file at the line
+    def run(self, edit):
+        selection = self.view.sel()
+        if(not len(selection)):
+            return
+        line = self.view.line(selection[0].begin())
+        header = self.view.substr(line)
+        if(not ParseReviewHeader(header)):
+            self.view.run_command('perforce_diff_goto_source')
+            return
+
+        nextheader = self.view.find(r'^==== ', line.end())
+        end = nextheader.begin() - 1 if nextheader else self.view.size()
+        if(end > line.end() + 1):
+            self.view.set_read_only(False)
+            self.view.erase(edit, sublime.Region(line.end() + 1, end))
+            self.view.set_read_only(True)
+        else:
+            ReviewFileThread(self.view, header).start()
+
+    def is_enabled(self):
+        return IsReviewView(self.view)
+
+class ListChangelistsAndReviewThread(Task):
+    def __init__(self, window, in_shelved):
+        self.window = window
+        self.shelved = in_shelved
+
+    def GetKind(self):
+        return ('ListChangelistsAndReviewThread', self.shelved)
+
+    def MakeChangelistsList(self):
+        self.changes = []
+        resultchangelists = []
+        if(not self.shelved):
+            self.changes.append('default')
+            resultchangelists.append('Default')
+        for change, description in ListPendingChangelists():
+            self.changes.append(change)
+            resultchangelists.append("Changelist " + change + " - " + description)
 
         return resultchangelists
+
+    def run(self):
+        self.changelists_list = self.MakeChangelistsList()
+
+    def done(self, in_result):
+        if not self.changelists_list:
+            sublime.error_message(__name__ + ': There are no changelists to list.')
+            return
+        self.window.show_quick_panel(self.changelists_list, self.on_done)
+
+    def on_done(self, picked):
+        if picked == -1:
+            return
+        RunInContext(self.context, ReviewChangelistThread(self.window, self.changes[picked], self.shelved).start)
+
+class PerforceReviewChangelistCommand(sublime_plugin.WindowCommand):
+    def run(self, shelved=False):
+        ListChangelistsAndReviewThread(self.window, shelved).start()
+
+# Reconcile section
+# finds the files modified, added or deleted outside of the editor without p4 reconcile, which makes the server read
+# the whole workspace. One p4 fstat -Ol gives the digest of the have revisions, the local files are only hashed when
+# their modification time or size changed since the previous run, the index of their digests is kept on disk
+reconcile_keyword_regex = re.compile(r'\$(Id|Header|Date|DateUTC|DateTime|DateTimeUTC|DateTimeTZ|Change|File|Revision|Author):[^$\n]*\$')
+reconcile_default_ignore = ['.git', '.hg', '.svn', '*.pyc', '*.pyo', '*.o', '*.obj', '.DS_Store', 'Thumbs.db']
+
+def GetLocalDigest(in_filename, in_type):
+    # the digest of p4 is the md5 of the revision as stored by the server: text files with unix line endings and
+    # their keywords not expanded. The file is read by chunks, only the last incomplete line of a chunk is kept
+    basetype, separator, modifiers = in_type.partition('+')
+    text = basetype in text_file_types
+    keywords = text and ('k' in modifiers or basetype in ('ktext', 'kxtext'))
+
+    md5 = hashlib.md5()
+    handle = open(in_filename, 'rb')
+    try:
+        pending = ''
+        while True:
+            chunk = handle.read(1024 * 1024)
+            data = chunk
+            if(text):
+                # the lines are kept whole, a line ending or a keyword is never split between two chunks
+                data = pending + chunk
+                end = data.rfind('\n') + 1 if chunk else len(data)
+                pending = data[end:]
+                data = data[:end].replace('\r\n', '\n')
+                if(keywords):
+                    data = reconcile_keyword_regex.sub(r'$\1$', data)
+            md5.update(data)
+            if(not chunk):
+                break
+    finally:
+        handle.close()
+    return md5.hexdigest().upper()
+
+def HashFiles(in_files, in_threads):
+    # returns the digest of each file, None when it couldn't be read. Only the reads release the interpreter lock, the
+    # hashing and the translation of text files don't on python 2.6: the threads overlap the waits on the disk with the
+    # hashing of other files but use a single core, each one only keeps a chunk of its file in memory
+    files = Queue()
+    for filename, filetype in in_files:
+        files.put((filename, filetype))
+    digests = {}
+    def work():
+        while True:
+            try:
+                filename, filetype = files.get_nowait()
+            except Empty:
+                return
+            try:
+                digests[filename] = GetLocalDigest(filename, filetype)
+            except (IOError, OSError):
+                digests[filename] = None
+
+    threads = []
+    for index in range(max(1, min(in_threads, len(in_files)))):
+        thread = threading.Thread(target=work)
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return digests
+
+def GetIndexFilePath(in_name, in_key):
+    # the indexes kept between sessions are in the temporary folder, one file per workspace
+    folder = os.path.join(tempfile.gettempdir(), 'SublimePerforce' + in_name)
+    if(not os.path.isdir(folder)):
+        os.makedirs(folder)
+    return os.path.join(folder, hashlib.sha1(in_key.encode('utf-8')).hexdigest())
+
+def LoadIndexFile(in_path):
+    try:
+        handle = open(in_path, 'rb')
+        try:
+            return marshal.load(handle)
+        finally:
+            handle.close()
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+
+def SaveIndexFile(in_path, in_index):
+    # written to a temporary name first, an index is never read half written
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(in_path), suffix='.tmp')
+    os.close(handle)
+    handle = open(tmp_path, 'wb')
+    try:
+        marshal.dump(in_index, handle)
+    finally:
+        handle.close()
+    RemoveFile(in_path)
+    os.rename(tmp_path, in_path)
+
+def IsReconcileIgnored(in_name, in_patterns):
+    for pattern in in_patterns:
+        if(fnmatch.fnmatch(in_name, pattern)):
+            return True
+    return False
+
+# P4IGNORE files hold one pattern per line relative to their folder, '#' starts a comment and '!' takes a file back.
+# A pattern without a slash matches the name at any depth, one ending with a slash only matches folders. The rules of a
+# folder apply after the ones of its parents and the last matching rule wins, nothing comes back from an ignored folder
+p4ignore_names = None
+
+def GetP4IgnoreNames():
+    global p4ignore_names
+    if(p4ignore_names is None):
+        value = os.environ.get('P4IGNORE', '')
+        if(not value):
+            result, err = RunP4(['set', '-q', 'P4IGNORE'])
+            if(not err and result.find('=') != -1):
+                value = result.strip().split('=', 1)[1].split(' (')[0]
+        p4ignore_names = [name for name in value.split(os.pathsep) if name]
+    return p4ignore_names
+
+def LoadP4IgnoreRules(in_path):
+    # returns the rules of an ignore file as (folder, negated, regex, folder only, anchored)
+    rules = []
+    try:
+        handle = open(in_path, 'r')
+        try:
+            lines = handle.read().splitlines()
+        finally:
+            handle.close()
+    except (IOError, OSError):
+        return rules
+    folder = os.path.dirname(in_path)
+    for line in lines:
+        pattern = line.strip()
+        if(not pattern or pattern.startswith('#')):
+            continue
+        negated = pattern.startswith('!')
+        if(negated):
+            pattern = pattern[1:]
+        folderonly = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        anchored = pattern.find('/') != -1
+        pattern = pattern.lstrip('/')
+        if(pattern):
+            rules.append((folder, negated, re.compile(fnmatch.translate(os.path.normcase(pattern))), folderonly, anchored))
+    return rules
+
+def GetP4IgnoreRules(in_folder, in_names):
+    # the rules found in the folder itself, relative names are looked for in every folder
+    rules = []
+    for name in in_names:
+        if(not os.path.isabs(name)):
+            rules += LoadP4IgnoreRules(os.path.join(in_folder, name))
+    return rules
+
+def IsP4Ignored(in_path, in_isfolder, in_rules):
+    ignored = False
+    for folder, negated, regex, folderonly, anchored in in_rules:
+        if(folderonly and not in_isfolder):
+            continue
+        if(anchored):
+            target = os.path.normcase(os.path.relpath(in_path, folder)).replace(os.sep, '/')
+        else:
+            target = os.path.normcase(os.path.basename(in_path))
+        if(regex.match(target)):
+            ignored = not negated
+    return ignored
+
+def FindReconcileChanges(in_folder, in_output):
+    # returns the local files to open for edit, add and delete, or the error message
+    perforce_settings = GetSettings()
+    info = GetWorkspaceInfo()
+    if(info is None):
+        return 0, "Unexpected output from 'p4 info'."
+    ignored = perforce_settings.get('perforce_reconcile_ignore', reconcile_default_ignore) + [GetP4ConfigName() or '.p4config']
+    wildcard = os.path.join(in_folder, '...')
+    # only the files mapped by the view of the client can be added
+    clientview = GetClientView()
+    if(clientview is None):
+        return 0, "Unexpected output from 'p4 client -o'."
+
+    # the P4IGNORE rules of the parents of the folder, outermost first, absolute files apply everywhere
+    ignorenames = GetP4IgnoreNames()
+    parentrules = []
+    for name in ignorenames:
+        if(os.path.isabs(name)):
+            parentrules += LoadP4IgnoreRules(name)
+    parents = []
+    folder = os.path.dirname(in_folder)
+    while folder != os.path.dirname(folder):
+        parents.append(folder)
+        folder = os.path.dirname(folder)
+    for folder in reversed(parents):
+        parentrules += GetP4IgnoreRules(folder, ignorenames)
+    folderrules = {in_folder: (parentrules + GetP4IgnoreRules(in_folder, ignorenames), False)}
+
+    # the have revisions of the folder and the files already opened, one process each
+    server = {}
+    for record in P4Records(['fstat', '-Ol', '-T', 'clientFile,headType,digest,fileSize', wildcard + '#have']):
+        if(IsErrorRecord(record)):
+            if(record.get('severity', 3) > 2): # no files is only a warning
+                return 0, GetRecordError(record)
+        elif(record.get('clientFile')):
+            server[file_state_index.Key(record['clientFile'])] = record
+    opened = set()
+    for record in P4Records(['fstat', '-Ro', '-T', 'clientFile', wildcard]):
+        if(IsErrorRecord(record)):
+            if(record.get('severity', 3) > 2):
+                return 0, GetRecordError(record)
+        elif(record.get('clientFile')):
+            opened.add(file_state_index.Key(record['clientFile']))
+    in_output(["%d file(s) synced, %d opened" % (len(server), len(opened))])
+
+    # local path -> modification time, size and digest of the file when it was hashed
+    indexpath = GetIndexFilePath('Reconcile', info.get('serverAddress', '') + '\n' + info.get('clientName', '') + '\n' + os.path.normcase(in_folder))
+    index = LoadIndexFile(indexpath) or {}
+    newindex = {}
+    edits = []
+    adds = []
+    candidates = []
+    for root, dirs, files in os.walk(in_folder):
+        dirs[:] = [name for name in dirs if not IsReconcileIgnored(name, ignored)]
+        # the folders ignored by P4IGNORE are still walked, their synced files can be edited or deleted
+        rules, rootignored = folderrules.pop(root, ([], False))
+        for name in dirs:
+            folder = os.path.join(root, name)
+            folderignored = rootignored or IsP4Ignored(folder, True, rules)
+            folderrules[folder] = (rules + GetP4IgnoreRules(folder, ignorenames), folderignored)
+        for name in files:
+            filename = os.path.join(root, name)
+            key = file_state_index.Key(filename)
+            record = server.pop(key, None)
+            if(key in opened):
+                continue
+            if(record is None):
+                if(not IsReconcileIgnored(name, ignored) and not rootignored and not IsP4Ignored(filename, False, rules) and clientview.LocalToDepot(filename) is not None):
+                    adds.append(filename)
+                continue
+            if(not record.get('digest') or os.path.islink(filename)):
+                continue
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+
+            filetype = record.get('headType', 'text')
+            entry = index.get(key)
+            if(entry and entry[0] == st.st_mtime and entry[1] == st.st_size):
+                newindex[key] = entry
+                if(entry[2] != record['digest']):
+                    edits.append(filename)
+            elif(not IsTextFileType(filetype) and str(st.st_size) != record.get('fileSize', str(st.st_size))):
+                edits.append(filename) # no translation of binary files, a different size is enough
+            else:
+                candidates.append((filename, filetype, key, st, record['digest']))
+
+    # the files of the depot which aren't on disk anymore, ignored folders weren't walked
+    deletes = []
+    for key, record in server.items():
+        if(key not in opened and not os.path.lexists(record['clientFile'])):
+            deletes.append(record['clientFile'])
+
+    in_output(["%d file(s) to hash" % len(candidates)])
+    digests = HashFiles([(candidate[0], candidate[1]) for candidate in candidates], perforce_settings.get('perforce_reconcile_threads', 4))
+    for filename, filetype, key, st, serverdigest in candidates:
+        digest = digests.get(filename)
+        if(digest is None):
+            continue
+        newindex[key] = (st.st_mtime, st.st_size, digest)
+        if(digest != serverdigest):
+            edits.append(filename)
+    SaveIndexFile(indexpath, newindex)
+
+    edits.sort()
+    adds.sort()
+    deletes.sort()
+    return 1, (edits, adds, deletes)
+
+def ApplyReconcileChanges(in_edits, in_adds, in_deletes):
+    # one batched command per action, returns the messages of the errors
+    errors = []
+    for args, filenames, action in ((['edit'], in_edits, 'edit'), (['add', '-f'], in_adds, 'add'), (['delete'], in_deletes, 'delete')):
+        for record in P4RecordsOnFiles(args, filenames):
+            if(IsErrorRecord(record)):
+                errors.append(GetRecordError(record))
+            elif(record.get('clientFile')):
+                file_state_index.Update(record['clientFile'], action=action, change='default')
+    return errors
+
+class ReconcileThread(Task):
+    def __init__(self, window, in_folder):
+        self.window = window
+        self.folder = in_folder
+        self.changes = None
+        ShowProgressPanel(window, "Perforce: reconcile " + in_folder)
+
+    def GetKind(self):
+        return ('ReconcileThread', self.folder)
+
+    def Output(self, in_lines):
+        AppendToProgressPanel(self.window, in_lines)
+
+    def run(self):
+        start = time.time()
+        success, result = FindReconcileChanges(self.folder, self.Output)
+        if(not success):
+            self.Output([result])
+            return
+        self.changes = result
+        edits, adds, deletes = result
+        for action, filenames in (('edit', edits), ('add', adds), ('delete', deletes)):
+            self.Output([action + ' ' + filename for filename in filenames])
+        self.Output(["%d to edit, %d to add, %d to delete, found in %.1f second(s)" % (len(edits), len(adds), len(deletes), time.time() - start)])
+
+    def done(self, in_result):
+        if(self.changes is None):
+            return
+        edits, adds, deletes = self.changes
+        if(not edits and not adds and not deletes):
+            sublime.status_message("Perforce: the files under " + self.folder + " match the depot")
+            return
+        self.window.show_quick_panel(["Open %d file(s) for edit, %d for add, %d for delete" % (len(edits), len(adds), len(deletes)), "Cancel"], self.on_done)
+
+    def on_done(self, picked):
+        if picked != 0:
+            return
+        edits, adds, deletes = self.changes
+        def apply():
+            errors = ApplyReconcileChanges(edits, adds, deletes)
+            GetCurrentContext().changelists.Invalidate()
+            self.Output(errors + ["Reconcile applied, %d error(s)" % len(errors)])
+        task_executor.Submit(apply, PRIORITY_INTERACTIVE, None, None, self.context)
+
+class PerforceReconcileCommand(sublime_plugin.WindowCommand):
+    def run(self, paths=None):
+        # the folders of the side bar, otherwise the whole client
+        folders = [path for path in (paths or []) if os.path.isdir(path)]
+        if(not folders):
+            clientroot = GetClientRoot()
+            if(clientroot == -1):
+                return
+            folders = [clientroot]
+        for folder in folders:
+            RunInContext(GetContext(folder), ReconcileThread(self.window, folder).start)
+
+# Open Depot File section
+# the have list of the client is indexed on disk so a file can be opened by name or depot path without asking the
+# server. The sorted depot paths are joined by new lines in a single string with the offset of each one, their file
+# names are joined the same way. A search is one regular expression over the joined names, which runs in C instead of
+# a python loop over every path, and a depot path is found by a binary search. The index is only loaded on first use
+def JoinLines(in_lines):
+    # returns the lines joined by new lines and the offset of each one, followed by the length of the text plus one
+    offsets = array.array('l')
+    position = 0
+    for line in in_lines:
+        offsets.append(position)
+        position += len(line) + 1
+    offsets.append(position)
+    return '\n'.join(in_lines), offsets
+
+def GetLine(in_text, in_offsets, in_index):
+    return in_text[in_offsets[in_index]:in_offsets[in_index + 1] - 1]
+
+class DepotFileIndex(object):
+    version = 1
+
+    def __init__(self, in_context):
+        self.context = in_context
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.change = None # highest change of the have revisions when the index was updated
+        self.validated = 0
+        self.SetPaths([])
+
+    def SetPaths(self, in_paths):
+        paths = sorted(set(in_paths))
+        self.paths, self.pathoffsets = JoinLines(paths)
+        # the names and paths are searched in lower case, without a case insensitive expression which is much slower
+        self.lowerpaths = self.paths.lower()
+        self.names, self.nameoffsets = JoinLines([path[path.rfind('/') + 1:].lower() for path in paths])
+
+    def GetPaths(self):
+        if(not self.paths):
+            return []
+        return self.paths.split('\n')
+
+    def GetCount(self):
+        return len(self.pathoffsets) - 1
+
+    def GetIndexFilePath(self):
+        info = GetWorkspaceInfo(self.context)
+        if(info is None):
+            return None
+        return GetIndexFilePath('DepotFiles', info.get('serverAddress', '') + '\n' + info.get('clientName', ''))
+
+    def Load(self, in_path):
+        index = LoadIndexFile(in_path)
+        self.loaded = True
+        if(not index or index.get('version') != self.version):
+            return
+        self.change = index['change']
+        self.paths = index['paths']
+        self.lowerpaths = self.paths.lower()
+        self.pathoffsets = array.array('l')
+        self.pathoffsets.fromstring(index['pathoffsets'])
+        self.names = index['names']
+        self.nameoffsets = array.array('l')
+        self.nameoffsets.fromstring(index['nameoffsets'])
+
+    def Save(self, in_path):
+        SaveIndexFile(in_path, {'version': self.version, 'change': self.change, 'paths': self.paths, 'pathoffsets': self.pathoffsets.tostring(),
+            'names': self.names, 'nameoffsets': self.nameoffsets.tostring()})
+
+    def GetHaveChange(self, in_clientname):
+        success, records = P4Run(['changes', '-m', '1', '//' + in_clientname + '/...#have'], None, self.context)
+        if(not success):
+            return 0, records
+        if(not records):
+            return 1, '0'
+        return 1, records[0].get('change', '0')
+
+    def Build(self):
+        paths = []
+        for record in P4Records(['have'], None, None, self.context):
+            if(IsErrorRecord(record)):
+                if(record.get('severity', 3) > 2): # no files synced is only a warning
+                    return 0, GetRecordError(record)
+            elif(record.get('depotFile')):
+                paths.append(record['depotFile'])
+        self.SetPaths(paths)
+        return 1, None
+
+    def UpdateFromChanges(self, in_clientname, in_change):
+        # the files of the changes submitted since the last update, added when they are synced and removed otherwise
+        added = []
+        removed = set()
+        filespec = '//' + in_clientname + '/...@' + str(int(self.change) + 1) + ',@' + in_change
+        for record in P4Records(['fstat', '-T', 'depotFile,haveRev,headAction', filespec], None, None, self.context):
+            if(IsErrorRecord(record)):
+                if(record.get('severity', 3) > 2):
+                    return 0, GetRecordError(record)
+            elif(record.get('depotFile')):
+                if(record.get('haveRev') and 'delete' not in record.get('headAction', '')):
+                    added.append(record['depotFile'])
+                else:
+                    removed.add(record['depotFile'])
+        if(added or removed):
+            self.SetPaths([path for path in self.GetPaths() if path not in removed] + added)
+        return 1, None
+
+    def Update(self, in_rebuild=False):
+        # returns the number of files indexed, or the error message
+        perforce_settings = GetSettings()
+        self.lock.acquire()
+        try:
+            path = self.GetIndexFilePath()
+            if(path is None):
+                return 0, "Unexpected output from 'p4 info'."
+            if(not self.loaded and not in_rebuild):
+                self.Load(path)
+            if(not in_rebuild and self.change is not None and time.time() - self.validated < perforce_settings.get('perforce_changelists_ttl', 10)):
+                return 1, self.GetCount()
+
+            clientname = GetWorkspaceInfo(self.context).get('clientName', '')
+            success, change = self.GetHaveChange(clientname)
+            if(not success):
+                return 0, change
+            if(in_rebuild or self.change is None or int(change) < int(self.change)):
+                success, message = self.Build()
+            elif(change != self.change):
+                success, message = self.UpdateFromChanges(clientname, change)
+            if(not success):
+                return 0, message
+            if(change != self.change or in_rebuild):
+                self.change = change
+                self.Save(path)
+            self.validated = time.time()
+            return 1, self.GetCount()
+        finally:
+            self.lock.release()
+
+    def Search(self, in_query, in_limit):
+        # the index isn't replaced by an update in the middle of a search
+        self.lock.acquire()
+        try:
+            return self.SearchLocked(in_query, in_limit)
+        finally:
+            self.lock.release()
+
+    def SearchLocked(self, in_query, in_limit):
+        # returns the depot paths matching the query, the file names containing it as typed come first
+        query = in_query.strip()
+        if(isinstance(query, unicode)):
+            query = query.encode('utf-8')
+        if(not query):
+            return []
+
+        if(query.startswith('//')):
+            # binary search of the depot paths starting with the query
+            low, high = 0, self.GetCount()
+            while low < high:
+                middle = (low + high) / 2
+                if(GetLine(self.paths, self.pathoffsets, middle) < query):
+                    low = middle + 1
+                else:
+                    high = middle
+            results = []
+            for index in range(low, min(low + in_limit, self.GetCount())):
+                path = GetLine(self.paths, self.pathoffsets, index)
+                if(not path.startswith(query)):
+                    break
+                results.append(path)
+            return results
+
+        # the characters of the query in the same order in the file name, or in the path when the query has a /
+        characters = query.replace(' ', '').lower()
+        if('/' in characters):
+            text, offsets = self.lowerpaths, self.pathoffsets
+        else:
+            text, offsets = self.names, self.nameoffsets
+
+        def Rank(in_index):
+            # the query as typed in the name, or in the path when it has a /, then at the start of the name
+            name = GetLine(self.names, self.nameoffsets, in_index)
+            return (characters not in GetLine(text, offsets, in_index), not name.startswith(characters), len(name), in_index)
+
+        if(text is self.names):
+            # the names containing the query rank before all the others, when there are enough of them the others
+            # aren't looked for. str.find skips to each one in C, the rest of its line is skipped
+            found = []
+            position = text.find(characters)
+            while position != -1:
+                index = bisect.bisect_right(offsets, position) - 1
+                found.append(index)
+                position = text.find(characters, offsets[index + 1])
+            if(len(found) >= in_limit):
+                return [GetLine(self.paths, self.pathoffsets, index) for index in heapq.nsmallest(in_limit, found, key=Rank)]
+        # each character is matched at its first occurrence after the previous one so there is no backtracking, and
+        # the expression starting with a literal lets the scan skip quickly to the candidates
+        regex = re.compile(re.escape(characters[0]) + ''.join(['[^\n' + re.escape(character) + ']*' + re.escape(character) for character in characters[1:]]))
+
+        found = set()
+        for match in regex.finditer(text):
+            found.add(bisect.bisect_right(offsets, match.start()) - 1)
+        return [GetLine(self.paths, self.pathoffsets, index) for index in heapq.nsmallest(in_limit, found, key=Rank)]
+
+class DepotFileIndexThread(Task):
+    def __init__(self, window, in_rebuild=False):
+        self.window = window
+        self.rebuild = in_rebuild
+
+    def GetKind(self):
+        return ('DepotFileIndexThread', self.rebuild)
+
+    def run(self):
+        return GetCurrentContext().depotfiles.Update(self.rebuild)
+
+    def done(self, in_result):
+        success, result = in_result
+        if(not success):
+            WarnUser(result)
+            return
+        if(self.rebuild):
+            sublime.status_message("Perforce: " + str(result) + " depot file(s) indexed")
+            return
+        self.window.show_input_panel('Open Depot File (' + str(result) + ' files)', '', self.on_query_done, None, None)
+
+    def on_query_done(self, query):
+        RunInContext(self.context, DepotFileSearchThread(self.window, query).start)
+
+class DepotFileSearchThread(Task):
+    # the search goes through the whole index, it doesn't freeze the interface
+    def __init__(self, window, in_query):
+        self.window = window
+        self.query = in_query
+        self.paths = []
+
+    def run(self):
+        start = time.time()
+        self.paths = self.context.depotfiles.Search(self.query, 200)
+        return time.time() - start
+
+    def done(self, in_result):
+        if(not self.paths):
+            sublime.status_message("Perforce: no depot file matches " + self.query)
+            return
+        sublime.status_message("Perforce: " + str(len(self.paths)) + " depot file(s) found in %d ms" % (in_result * 1000))
+        self.window.show_quick_panel([[path[path.rfind('/') + 1:], path] for path in self.paths], self.on_done)
+
+    def on_done(self, picked):
+        if picked == -1:
+            return
+        clientview = GetClientView(self.context)
+        filename = clientview.DepotToLocal(self.paths[picked]) if clientview else None
+        if(filename is None):
+            WarnUser(self.paths[picked] + " is not mapped in the client view.")
+            return
+
+        def open_file():
+            self.window.open_file(filename)
+        sublime.set_timeout(open_file, 10)
+
+class PerforceOpenDepotFileCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        DepotFileIndexThread(self.window).start()
+
+class PerforceRebuildDepotFileIndexCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        DepotFileIndexThread(self.window, True).start()
+
+TrackActions(globals())
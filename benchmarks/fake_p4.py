@@ -0,0 +1,182 @@
+# Stand-in for the p4 command line client used by the benchmarks.
+#
+# It answers the commands the plugin sends with synthetic records shaped like the ones of a real server, or with
+# the output recorded from a real server when FAKE_P4_RECORDINGS names a folder containing a file per command
+# (e.g. "info" holding the output of "p4 -G info"). The environment describes the workspace:
+#   FAKE_P4_ROOT        client root, the depot is //depot/... and the client is named after FAKE_P4_CLIENT
+#   FAKE_P4_CLIENT      client name, "bench" by default
+#   FAKE_P4_OPENED      number of opened files
+#   FAKE_P4_CHANGES     number of pending changelists
+#   FAKE_P4_PRINT_LINES number of lines of the revisions printed by p4 print
+#   FAKE_P4_LATENCY     milliseconds spent before answering, the round trip to the server
+#   FAKE_P4_LOG         file to which the arguments of every invocation are appended
+import marshal, os, sys, time
+
+root = os.environ.get('FAKE_P4_ROOT', os.getcwd()).rstrip('/\\')
+client = os.environ.get('FAKE_P4_CLIENT', 'bench')
+user = 'bench'
+opened_count = int(os.environ.get('FAKE_P4_OPENED', '0'))
+changes_count = int(os.environ.get('FAKE_P4_CHANGES', '0'))
+first_change = 1000
+
+def Output():
+    if(sys.platform == 'win32'):
+        import msvcrt
+        msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
+    return getattr(sys.stdout, 'buffer', sys.stdout)
+
+out = Output()
+
+def Write(in_record):
+    in_record.setdefault('code', 'stat')
+    out.write(marshal.dumps(in_record, 0))
+
+def Error(in_message, in_marshal):
+    if(in_marshal):
+        Write({'code': 'error', 'data': in_message + '\n', 'severity': 3, 'generic': 1})
+    else:
+        sys.stderr.write(in_message + '\n')
+    sys.exit(1)
+
+def LocalToDepot(in_path):
+    path = in_path.replace('\\', '/')
+    prefix = root.replace('\\', '/') + '/'
+    if(not path.startswith(prefix)):
+        return None
+    return '//depot/' + path[len(prefix):]
+
+def ChangeOfOpenedFile(in_index):
+    # one file in four stays in the default changelist, the others are spread over the pending changelists
+    if(not changes_count or in_index % 4 == 0):
+        return 'default'
+    return str(first_change + in_index % changes_count)
+
+def OpenedFile(in_index):
+    return 'src/dir%03d/file%06d.cpp' % (in_index % 500, in_index)
+
+def ReadFileArguments(in_args):
+    if(in_args[:2] == ['-x', '-']):
+        return [line for line in sys.stdin.read().splitlines() if line]
+    return in_args
+
+def Info(in_args, in_marshal):
+    Write({'userName': user, 'clientName': client, 'clientRoot': root, 'clientHost': 'bench',
+        'serverAddress': 'bench:1666', 'serverVersion': 'P4D/NTX64/2012.2/536738', 'caseHandling': 'sensitive'})
+
+def Set(in_args, in_marshal):
+    pass
+
+def Client(in_args, in_marshal):
+    if(in_args[:1] != ['-o']):
+        Error("Only 'client -o' is supported.", in_marshal)
+    Write({'Client': client, 'Owner': user, 'Root': root, 'Options': 'noallwrite noclobber nocompress unlocked nomodtime normdir',
+        'LineEnd': 'local', 'View0': '//depot/... //' + client + '/...'})
+
+def Changes(in_args, in_marshal):
+    if(in_args[:2] == ['-m', '1']):
+        Write({'change': str(first_change + changes_count), 'time': '1350000000', 'user': user, 'client': client,
+            'status': 'submitted', 'desc': 'Last submitted change\n'})
+        return
+    for index in range(changes_count - 1, -1, -1):
+        Write({'change': str(first_change + index), 'time': str(1350000000 + index), 'user': user, 'client': client,
+            'status': 'pending', 'changeType': 'public', 'desc': 'Pending change number %d of the benchmark\n' % index})
+
+def Opened(in_args, in_marshal):
+    for index in range(opened_count):
+        path = OpenedFile(index)
+        Write({'depotFile': '//depot/' + path, 'clientFile': '//' + client + '/' + path, 'rev': '3', 'haveRev': '3',
+            'action': 'edit', 'change': ChangeOfOpenedFile(index), 'type': 'text', 'user': user, 'client': client})
+
+def Fstat(in_args, in_marshal):
+    if(in_args[:1] == ['-Ro']):
+        for index in range(opened_count):
+            path = OpenedFile(index)
+            Write({'depotFile': '//depot/' + path, 'clientFile': os.path.join(root, path), 'haveRev': '3', 'headRev': '3',
+                'headType': 'text', 'action': 'edit', 'change': ChangeOfOpenedFile(index), 'type': 'text'})
+        return
+    for filename in ReadFileArguments(in_args):
+        depotfile = LocalToDepot(filename)
+        if(depotfile is None):
+            Write({'code': 'error', 'data': filename + ' - file(s) not in client view.\n', 'severity': 2})
+            continue
+        Write({'depotFile': depotfile, 'clientFile': filename, 'haveRev': '3', 'headRev': '3', 'headType': 'text',
+            'headAction': 'edit', 'headChange': str(first_change)})
+
+def Edit(in_args, in_marshal):
+    for filename in ReadFileArguments(in_args):
+        depotfile = LocalToDepot(filename)
+        if(depotfile is None):
+            Write({'code': 'error', 'data': filename + ' - file(s) not in client view.\n', 'severity': 2})
+            continue
+        if(os.path.isfile(filename)):
+            os.chmod(filename, 0o644)
+        Write({'depotFile': depotfile, 'clientFile': filename, 'workRev': '3', 'action': 'edit', 'type': 'text'})
+
+def Print(in_args, in_marshal):
+    if('-o' not in in_args):
+        Error("Only 'print -o' is supported.", in_marshal)
+    lines = int(os.environ.get('FAKE_P4_PRINT_LINES', '2000'))
+    target = open(in_args[in_args.index('-o') + 1], 'wb')
+    try:
+        for index in range(lines):
+            target.write(('    line %d of the revision printed by the benchmark\n' % index).encode('ascii'))
+    finally:
+        target.close()
+    if(in_marshal):
+        Write({'depotFile': in_args[-1].split('#')[0], 'rev': '3', 'change': str(first_change), 'action': 'edit', 'type': 'text'})
+
+commands = {
+    'info': Info,
+    'set': Set,
+    'client': Client,
+    'changes': Changes,
+    'opened': Opened,
+    'fstat': Fstat,
+    'edit': Edit,
+    'print': Print,
+}
+
+def Main(in_args):
+    log = os.environ.get('FAKE_P4_LOG')
+    if(log):
+        logfile = open(log, 'a')
+        try:
+            logfile.write(' '.join(in_args) + '\n')
+        finally:
+            logfile.close()
+
+    latency = float(os.environ.get('FAKE_P4_LATENCY', '0'))
+    if(latency):
+        time.sleep(latency / 1000.0)
+
+    # the global options come before the command, -x - is kept with the command as it brings the file arguments
+    args = list(in_args)
+    usemarshal = False
+    batch = []
+    while args and args[0].startswith('-'):
+        option = args.pop(0)
+        if(option == '-G'):
+            usemarshal = True
+        elif(option == '-x'):
+            batch = ['-x', args.pop(0)]
+        elif(option in ('-c', '-p', '-u', '-P', '-d', '-H', '-C', '-Q', '-z')):
+            args.pop(0)
+    if(not args):
+        Error('Missing command.', usemarshal)
+    command = args.pop(0)
+
+    recordings = os.environ.get('FAKE_P4_RECORDINGS')
+    if(recordings and os.path.isfile(os.path.join(recordings, command))):
+        recording = open(os.path.join(recordings, command), 'rb')
+        try:
+            out.write(recording.read())
+        finally:
+            recording.close()
+        return
+
+    if(command not in commands):
+        Error("Unknown command '%s'." % command, usemarshal)
+    commands[command](batch + args, usemarshal)
+
+if __name__ == '__main__':
+    Main(sys.argv[1:])
@@ -0,0 +1,500 @@
+# Benchmarks of the Perforce plugin against the stand-in p4 of fake_p4.py.
+#
+# Each scenario runs in its own python process with sublime and sublime_plugin stubbed out, so the caches of the
+# plugin start cold and the peak memory is the one of the scenario. The p4 processes spawned, the wall time and
+# the peak memory are compared with baseline.json and the run fails when one of them regressed.
+#
+#   python benchmarks/run.py                      run every scenario and compare with the baseline
+#   python benchmarks/run.py list_checked_out_1k  run only some scenarios
+#   python benchmarks/run.py --update-baseline    store the results as the new baseline
+#
+# The plugin is written for the python 2.6 of Sublime Text 2, the benchmarks have to run with a python 2 as well.
+from __future__ import print_function
+
+import json, marshal, optparse, os, shutil, stat, subprocess, sys, tempfile, time, types
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+plugin_dir = os.path.dirname(benchmarks_dir)
+baseline_path = os.path.join(benchmarks_dir, 'baseline.json')
+
+# Scenarios section
+# each scenario describes the workspace answered by the fake p4 and the entry point of the plugin it measures
+def RunCheckout(in_plugin, in_root):
+    # files saved one after the other, each of them is checked out on its own
+    filenames = CreateFiles(in_root, ['src/checkout/file%03d.cpp' % index for index in range(50)], True)
+    for filename in filenames:
+        success, message = in_plugin.Checkout(filename)
+        if(not success or success == -1):
+            raise AssertionError('Checkout of ' + filename + ' failed: ' + str(message))
+
+def RunIsFileInDepot(in_plugin, in_root):
+    # the auto add and the auto checkout ask for every file saved, only the first one should reach the server
+    for index in range(10000):
+        folder = os.path.join(in_root, 'src', 'dir%03d' % (index % 500))
+        if(in_plugin.IsFileInDepot(folder, 'new%06d.cpp' % index) != -1):
+            raise AssertionError('The files under the client root should be in the client view.')
+
+def RunListCheckedOutFiles(in_plugin, in_root):
+    files_list = in_plugin.ListCheckedOutFilesThread(None).MakeCheckedOutFileList()
+    expected = int(os.environ['FAKE_P4_OPENED'])
+    if(len(files_list) != expected):
+        raise AssertionError('%d checked out file(s) listed instead of %d.' % (len(files_list), expected))
+
+def RunPendingChangelists(in_plugin, in_root):
+    # the quick panels of the changelists ask for them every time they are shown
+    expected = int(os.environ['FAKE_P4_CHANGES'])
+    for index in range(20):
+        success, records = in_plugin.GetPendingChangelists()
+        if(not success or len(records) != expected):
+            raise AssertionError('Unexpected pending changelists: ' + str(records)[:200])
+
+def RunGraphicalDiff(in_plugin, in_root):
+    # the same file diffed again, the have revision should come from the revision cache
+    filename = CreateFiles(in_root, ['src/diff/file.cpp'], False)[0]
+    command = 'rem' if os.name == 'nt' else ':'
+    for index in range(10):
+        in_plugin.GraphicalDiffThread(os.path.dirname(filename), os.path.basename(filename), command).run()
+    if(in_plugin.revision_cache.misses != 1):
+        raise AssertionError('The revision was printed %d time(s).' % in_plugin.revision_cache.misses)
+
+def RunParseRecords(in_plugin, in_root):
+    # a recorded output of 20k records is parsed from a file, then the same number comes from the pipe of p4
+    expected = int(os.environ['FAKE_P4_OPENED'])
+    recording = os.path.join(os.environ['BENCHMARK_FOLDER'], 'fstat')
+    handle = open(recording, 'wb')
+    try:
+        for index in range(expected):
+            path = 'src/dir%03d/file%06d.cpp' % (index % 500, index)
+            handle.write(marshal.dumps({'code': 'stat', 'depotFile': '//depot/' + path, 'clientFile': os.path.join(in_root, path),
+                'isMapped': '', 'headAction': 'edit', 'headType': 'text', 'headTime': '1350000000', 'headRev': '12',
+                'headChange': str(1000 + index), 'headModTime': '1349990000', 'haveRev': '12'}, 0))
+    finally:
+        handle.close()
+
+    handle = open(recording, 'rb')
+    try:
+        count = len(list(in_plugin.ReadRecords(handle)))
+    finally:
+        handle.close()
+    if(count != expected):
+        raise AssertionError('%d record(s) read from the recording instead of %d.' % (count, expected))
+
+    count = 0
+    for record in in_plugin.P4Records(['fstat', '-Ro']):
+        if(in_plugin.IsErrorRecord(record)):
+            raise AssertionError('Unexpected error: ' + in_plugin.GetRecordError(record))
+        count += 1
+    if(count != expected):
+        raise AssertionError('%d record(s) read from p4 instead of %d.' % (count, expected))
+
+def RunSpawnOverhead(in_plugin, in_root):
+    # the commands used to go through a shell sourcing the bash profile (on osx), they are now started directly.
+    # A native program doing nothing stands for p4 so only the cost of starting it is measured, the same program is
+    # run both ways and the direct one has to be faster
+    executable = '/bin/true'
+    if(not os.path.isfile(executable)):
+        executable = os.environ['BENCHMARK_P4_EXECUTABLE']
+    if(os.name == 'nt'):
+        legacy = '"%s" -G info' % executable
+    else:
+        profile = os.path.join(os.environ['BENCHMARK_FOLDER'], 'bash_profile')
+        handle = open(profile, 'w')
+        try:
+            handle.write('export PATH="$PATH:/usr/local/bin"\nexport P4CONFIG=.p4config\n')
+        finally:
+            handle.close()
+        legacy = 'source "%s" && "%s" -G info' % (profile, executable)
+
+    in_plugin.settings_snapshot.values['perforce_p4_executable'] = executable
+    in_plugin.p4_runner.Invalidate()
+    in_plugin.RunP4(['-G', 'info'])
+
+    # the rounds alternate so a slower moment of the machine affects both, the fastest round of each is compared
+    legacytimes = []
+    directtimes = []
+    for round in range(10):
+        start = time.time()
+        for index in range(20):
+            p = subprocess.Popen(legacy, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=in_root, shell=True,
+                executable=None if os.name == 'nt' else '/bin/bash')
+            p.communicate()
+        legacytimes.append(time.time() - start)
+
+        start = time.time()
+        for index in range(20):
+            result, err = in_plugin.RunP4(['-G', 'info'])
+            if(err):
+                raise AssertionError('p4 info failed: ' + err)
+        directtimes.append(time.time() - start)
+    if(min(directtimes) >= min(legacytimes)):
+        raise AssertionError('20 direct commands took %.3fs, %.3fs through the shell.' % (min(directtimes), min(legacytimes)))
+
+# the views are checked against the client paths p4 where gives for them, None when the depot file isn't mapped
+client_view_cases = [
+    (['//depot/main/... //bench/main/...'],
+        [('//depot/main/a.cpp', '//bench/main/a.cpp'), ('//depot/main/sub/dir/b.h', '//bench/main/sub/dir/b.h'), ('//depot/other/a.cpp', None)]),
+    (['//depot/flat/* //bench/flat/*', '//depot/src/*.cpp //bench/cpp/*.cc'],
+        [('//depot/flat/a.txt', '//bench/flat/a.txt'), ('//depot/flat/sub/a.txt', None), ('//depot/src/main.cpp', '//bench/cpp/main.cc'),
+         ('//depot/src/main.h', None)]),
+    (['//depot/%%1/%%2.c //bench/%%2/%%1.c', '//depot/lib/.../%%1.h //bench/include/%%1/....h'],
+        [('//depot/core/io.c', '//bench/io/core.c'), ('//depot/core/sub/io.c', None), ('//depot/lib/a/b/list.h', '//bench/include/list/a/b.h')]),
+    (['//depot/main/... //bench/main/...', '-//depot/main/generated/... //bench/main/generated/...', '-//depot/main/....obj //bench/main/....obj'],
+        [('//depot/main/src/a.cpp', '//bench/main/src/a.cpp'), ('//depot/main/generated/a.cpp', None), ('//depot/main/src/a.obj', None)]),
+    (['//depot/main/... //bench/main/...', '+//depot/patches/... //bench/main/...'],
+        [('//depot/main/a.cpp', '//bench/main/a.cpp'), ('//depot/patches/a.cpp', '//bench/main/a.cpp')]),
+    (['//depot/main/... //bench/main/...', '//depot/vendor/zlib/... //bench/main/zlib/...'],
+        [('//depot/main/a.cpp', '//bench/main/a.cpp'), ('//depot/main/zlib/inflate.c', None), ('//depot/vendor/zlib/inflate.c', '//bench/main/zlib/inflate.c')]),
+    (['"//depot/my docs/..." "//bench/docs and notes/..."', '//depot/main/... "//bench/main dir/..."'],
+        [('//depot/my docs/read me.txt', '//bench/docs and notes/read me.txt'), ('//depot/main/a b.cpp', '//bench/main dir/a b.cpp')]),
+]
+
+def RunClientViewCases(in_plugin, in_root):
+    # depot to client, the client paths back to the depot files owning them and the local paths of the workspace
+    for lines, cases in client_view_cases:
+        clientview = in_plugin.ClientView('bench', [in_root], lines, False)
+        for depotpath, expected in cases:
+            clientpath = clientview.DepotToClient(depotpath)
+            if(clientpath != expected):
+                raise AssertionError('%s maps to %s instead of %s with the view %s' % (depotpath, clientpath, expected, lines))
+            if(expected is None):
+                continue
+            owner = clientview.ClientToDepot(clientpath)
+            if(owner != depotpath and not lines[-1].startswith('+')):
+                raise AssertionError('%s maps back to %s instead of %s with the view %s' % (clientpath, owner, depotpath, lines))
+            localpath = clientview.ClientToLocal(clientpath)
+            if(clientview.LocalToDepot(localpath) != owner):
+                raise AssertionError('%s maps to %s instead of %s' % (localpath, clientview.LocalToDepot(localpath), owner))
+
+    # an overlay doesn't take the file over, the client file is the one of the last line
+    clientview = in_plugin.ClientView('bench', [in_root], client_view_cases[4][0], False)
+    if(clientview.ClientToDepot('//bench/main/a.cpp') != '//depot/patches/a.cpp'):
+        raise AssertionError('The overlay should own //bench/main/a.cpp.')
+    clientview = in_plugin.ClientView('bench', [in_root], ['//depot/Main/... //bench/main/...'], True)
+    if(clientview.DepotToClient('//DEPOT/main/A.cpp') is None):
+        raise AssertionError('The paths should be compared without the case on a case insensitive server.')
+
+def RunClientViewClassification(in_plugin, in_root):
+    # the files saved are classified without the server, a view of a large workspace should take at most a second
+    # for 100k paths
+    lines = ['//depot/main/... //bench/main/...']
+    for index in range(40):
+        lines.append('-//depot/main/module%02d/generated/... //bench/main/module%02d/generated/...' % (index, index))
+        lines.append('//depot/vendor/lib%02d/... //bench/main/module%02d/lib/...' % (index, index))
+    lines.append('-//depot/main/....obj //bench/main/....obj')
+    clientview = in_plugin.ClientView('bench', [in_root], lines, False)
+    localpaths = []
+    for index in range(100000):
+        folder = ['src', 'generated', 'lib', 'include'][index % 4]
+        localpaths.append(os.path.join(in_root, 'main', 'module%02d' % (index % 50), folder, 'file%06d.cpp' % index))
+
+    start = time.time()
+    mapped = 0
+    for localpath in localpaths:
+        if(clientview.LocalToDepot(localpath) is not None):
+            mapped += 1
+    elapsed = time.time() - start
+    if(mapped != 100000 - 20000):
+        raise AssertionError('%d paths mapped instead of %d.' % (mapped, 100000 - 20000))
+    if(elapsed > 1):
+        raise AssertionError('100k paths classified in %.3fs, fewer than 100k paths per second.' % elapsed)
+
+scenarios = [
+    {'name': 'checkout', 'run': RunCheckout, 'opened': 1000, 'changes': 500},
+    {'name': 'is_file_in_depot', 'run': RunIsFileInDepot, 'opened': 1000, 'changes': 500},
+    {'name': 'list_checked_out_1k', 'run': RunListCheckedOutFiles, 'opened': 1000, 'changes': 500},
+    {'name': 'list_checked_out_10k', 'run': RunListCheckedOutFiles, 'opened': 10000, 'changes': 500},
+    {'name': 'list_checked_out_100k', 'run': RunListCheckedOutFiles, 'opened': 100000, 'changes': 500},
+    {'name': 'pending_changelists', 'run': RunPendingChangelists, 'opened': 1000, 'changes': 500},
+    {'name': 'graphical_diff', 'run': RunGraphicalDiff, 'opened': 1000, 'changes': 500},
+    {'name': 'spawn_overhead', 'run': RunSpawnOverhead, 'opened': 0, 'changes': 0},
+    {'name': 'parse_records_20k', 'run': RunParseRecords, 'opened': 20000, 'changes': 500},
+    {'name': 'client_view_cases', 'run': RunClientViewCases, 'opened': 0, 'changes': 0},
+    {'name': 'client_view_100k', 'run': RunClientViewClassification, 'opened': 0, 'changes': 0},
+]
+
+def GetScenario(in_name):
+    for scenario in scenarios:
+        if(scenario['name'] == in_name):
+            return scenario
+    raise KeyError("Unknown scenario '%s'." % in_name)
+
+def CreateFiles(in_root, in_paths, in_readonly):
+    filenames = []
+    for path in in_paths:
+        filename = os.path.join(in_root, *path.split('/'))
+        if(not os.path.isdir(os.path.dirname(filename))):
+            os.makedirs(os.path.dirname(filename))
+        handle = open(filename, 'w')
+        try:
+            handle.write('int main() { return 0; }\n')
+        finally:
+            handle.close()
+        if(in_readonly):
+            os.chmod(filename, stat.S_IREAD)
+        filenames.append(filename)
+    return filenames
+
+# Sublime stubs section
+# only what the plugin uses outside of its commands is provided, the timeouts are never run so the periodic
+# refreshes of the plugin don't add p4 commands to the ones of the scenario
+def LoadSettings(in_path):
+    # the settings file has comments after the values, they are removed outside of the strings
+    lines = []
+    handle = open(in_path)
+    try:
+        for line in handle:
+            instring = False
+            escaped = False
+            for index, character in enumerate(line):
+                if(escaped):
+                    escaped = False
+                elif(character == '\\'):
+                    escaped = True
+                elif(character == '"'):
+                    instring = not instring
+                elif(not instring and line.startswith('//', index)):
+                    line = line[0:index] + '\n'
+                    break
+            lines.append(line)
+    finally:
+        handle.close()
+    return json.loads(''.join(lines))
+
+class StubSettings(object):
+    def __init__(self, in_values):
+        self.values = in_values
+
+    def get(self, in_name, in_default=None):
+        return self.values.get(in_name, in_default)
+
+    def set(self, in_name, in_value):
+        self.values[in_name] = in_value
+
+    def add_on_change(self, in_key, in_callback):
+        pass
+
+    def clear_on_change(self, in_key):
+        pass
+
+class StubRegion(object):
+    def __init__(self, in_a, in_b=None):
+        self.a = in_a
+        self.b = in_a if in_b is None else in_b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+def InstallStubs(in_settings, in_packages):
+    sublime = types.ModuleType('sublime')
+    settings = StubSettings(in_settings)
+    sublime.load_settings = lambda in_name: settings
+    sublime.save_settings = lambda in_name: None
+    sublime.platform = lambda: {'win32': 'windows', 'darwin': 'osx'}.get(sys.platform, 'linux')
+    sublime.packages_path = lambda: in_packages
+    sublime.set_timeout = lambda in_callback, in_delay: None
+    sublime.status_message = lambda in_message: None
+    sublime.error_message = lambda in_message: None
+    sublime.message_dialog = lambda in_message: None
+    sublime.windows = lambda: []
+    sublime.active_window = lambda: None
+    sublime.Region = StubRegion
+    sublime.HIDDEN = 4
+    sublime.PERSISTENT = 8
+    sublime.DRAW_EMPTY = 32
+    sublime.DRAW_OUTLINED = 2
+    sublime.DRAW_EMPTY_AS_OVERWRITE = 1
+    sublime.HIDE_ON_MINIMAP = 16
+
+    sublime_plugin = types.ModuleType('sublime_plugin')
+    for name in ('EventListener', 'TextCommand', 'WindowCommand', 'ApplicationCommand'):
+        setattr(sublime_plugin, name, type(name, (object,), {'__init__': lambda self, *in_args: None}))
+
+    sys.modules['sublime'] = sublime
+    sys.modules['sublime_plugin'] = sublime_plugin
+
+# Measurement section
+def GetPeakMemory():
+    # in kilobytes, None where the resource module isn't available
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if(sys.platform == 'darwin'):
+        peak /= 1024
+    return int(peak)
+
+def CountSpawns(in_log):
+    if(not os.path.isfile(in_log)):
+        return 0
+    handle = open(in_log)
+    try:
+        return len(handle.readlines())
+    finally:
+        handle.close()
+
+def RunScenarioHere(in_name):
+    # runs in the process started by RunScenario, the result is written as json on the last line of the output
+    scenario = GetScenario(in_name)
+    root = os.environ['FAKE_P4_ROOT']
+
+    settings = LoadSettings(os.path.join(plugin_dir, 'Perforce.sublime-settings'))
+    settings.update({
+        'perforce_p4_executable': os.environ['BENCHMARK_P4_EXECUTABLE'],
+        'perforce_revision_cache_folder': os.path.join(os.environ['BENCHMARK_FOLDER'], 'revisions'),
+        'perforce_slow_command_threshold': 0,
+        'perforce_telemetry': False,
+        'perforce_track': False,
+        'perforce_warnings_enabled': False,
+    })
+    InstallStubs(settings, os.environ['BENCHMARK_FOLDER'])
+    sys.path.insert(0, plugin_dir)
+    # like Sublime Text, the plugin is loaded from its own folder
+    folder = os.getcwd()
+    os.chdir(plugin_dir)
+    try:
+        import Perforce
+    finally:
+        os.chdir(folder)
+
+    log = os.environ['FAKE_P4_LOG']
+    spawns = CountSpawns(log)
+    start = time.time()
+    scenario['run'](Perforce, root)
+    wall = time.time() - start
+
+    print(json.dumps({'spawns': CountSpawns(log) - spawns, 'wall': round(wall, 3), 'memory': GetPeakMemory()}))
+
+def WriteExecutable(in_folder):
+    # p4 is started without a shell, the fake one needs a launcher of its own
+    fake = os.path.join(benchmarks_dir, 'fake_p4.py')
+    if(os.name == 'nt'):
+        path = os.path.join(in_folder, 'p4.bat')
+        content = '@"%s" "%s" %%*\r\n' % (sys.executable, fake)
+    else:
+        path = os.path.join(in_folder, 'p4')
+        content = '#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, fake)
+    handle = open(path, 'w')
+    try:
+        handle.write(content)
+    finally:
+        handle.close()
+    os.chmod(path, stat.S_IRWXU)
+    return path
+
+def RunScenario(in_scenario, in_options):
+    folder = tempfile.mkdtemp(prefix='p4bench')
+    try:
+        root = os.path.join(folder, 'workspace')
+        os.makedirs(root)
+        handle = open(os.path.join(root, '.p4config'), 'w')
+        try:
+            handle.write('P4CLIENT=bench\n')
+        finally:
+            handle.close()
+
+        environment = dict(os.environ)
+        environment.update({
+            'BENCHMARK_FOLDER': folder,
+            'BENCHMARK_P4_EXECUTABLE': WriteExecutable(folder),
+            'FAKE_P4_ROOT': root,
+            'FAKE_P4_OPENED': str(in_scenario['opened']),
+            'FAKE_P4_CHANGES': str(in_scenario['changes']),
+            'FAKE_P4_LATENCY': str(in_options.latency),
+            'FAKE_P4_LOG': os.path.join(folder, 'p4.log'),
+            'P4CONFIG': '.p4config',
+        })
+        if(in_options.recordings):
+            environment['FAKE_P4_RECORDINGS'] = os.path.abspath(in_options.recordings)
+
+        p = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--scenario', in_scenario['name']], stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=folder, env=environment)
+        result, err = p.communicate()
+        if(p.returncode != 0):
+            return None, err.decode('utf-8', 'replace').strip()
+        return json.loads(result.decode('utf-8').strip().splitlines()[-1]), None
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+# Baseline section
+def LoadBaseline():
+    if(not os.path.isfile(baseline_path)):
+        return {}
+    handle = open(baseline_path)
+    try:
+        return json.load(handle)
+    finally:
+        handle.close()
+
+def SaveBaseline(in_baseline):
+    handle = open(baseline_path, 'w')
+    try:
+        json.dump(in_baseline, handle, indent=4, sort_keys=True, separators=(',', ': '))
+        handle.write('\n')
+    finally:
+        handle.close()
+
+def GetRegressions(in_result, in_baseline, in_tolerance):
+    # the p4 processes are deterministic and compared exactly, the wall time and the memory depend on the machine
+    # and get a relative tolerance, the wall time also gets a few milliseconds for the scheduling noise
+    regressions = []
+    if(in_result['spawns'] > in_baseline['spawns']):
+        regressions.append('%d p4 spawns instead of %d' % (in_result['spawns'], in_baseline['spawns']))
+    if(in_result['wall'] > in_baseline['wall'] * (1 + in_tolerance) + 0.05):
+        regressions.append('%.3fs instead of %.3fs' % (in_result['wall'], in_baseline['wall']))
+    if(in_result['memory'] and in_baseline.get('memory') and in_result['memory'] > in_baseline['memory'] * (1 + in_tolerance)):
+        regressions.append('%d KB instead of %d KB' % (in_result['memory'], in_baseline['memory']))
+    return regressions
+
+def FormatMemory(in_memory):
+    if(in_memory is None):
+        return '-'
+    return '%d KB' % in_memory
+
+def Main():
+    parser = optparse.OptionParser(usage='%prog [options] [scenario...]')
+    parser.add_option('--latency', type='float', default=5, help='milliseconds spent by the fake p4 before answering (default: %default)')
+    parser.add_option('--recordings', help='folder of recorded outputs replayed by the fake p4, one file per command')
+    parser.add_option('--tolerance', type='float', default=0.5, help='relative increase of the wall time and the memory accepted (default: %default)')
+    parser.add_option('--update-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_option('--scenario', help=optparse.SUPPRESS_HELP)
+    options, names = parser.parse_args()
+
+    if(options.scenario):
+        RunScenarioHere(options.scenario)
+        return 0
+
+    selected = [GetScenario(name) for name in names] if names else scenarios
+    baseline = LoadBaseline()
+    failures = 0
+
+    print('%-24s %8s %10s %12s  %s' % ('scenario', 'spawns', 'wall', 'memory', 'status'))
+    for scenario in selected:
+        result, err = RunScenario(scenario, options)
+        if(result is None):
+            failures += 1
+            print('%-24s %8s %10s %12s  failed' % (scenario['name'], '-', '-', '-'))
+            print(err, file=sys.stderr)
+            continue
+
+        status = 'ok'
+        if(options.update_baseline):
+            baseline[scenario['name']] = result
+            status = 'stored'
+        elif(scenario['name'] not in baseline):
+            status = 'no baseline'
+        else:
+            regressions = GetRegressions(result, baseline[scenario['name']], options.tolerance)
+            if(regressions):
+                failures += 1
+                status = 'regressed: ' + ', '.join(regressions)
+        print('%-24s %8d %9.3fs %12s  %s' % (scenario['name'], result['spawns'], result['wall'], FormatMemory(result['memory']), status))
+
+    if(options.update_baseline):
+        SaveBaseline(baseline)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(Main())